@@ -1,12 +1,33 @@
 #! /usr/bin/env python3
 
 import argparse
-from datetime import datetime
+from array import array
+import base64
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import cProfile
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import hashlib
+import heapq
+import itertools
 import json
 import os
+import re
+import sqlite3
+import sys
+import time
+from urllib.parse import urlsplit
 
 
-import plotly.graph_objects as go
+import numpy as np
+
+# `graphs` imports plotly, which takes a large part of a second, so it is only imported where a figure gets built
+from atomic_file import atomic_path
+from json_stream import CHUNK_SIZE, WHOLE_FILE_SIZE, MessageFileReader
+from profiling import Profiler
+from search_index import SearchIndex, tokenize
+from sketches import HyperLogLog, WordSketch
 
 ###########################################################################
 # Parameters
@@ -32,6 +53,38 @@ min_call_duration_length = 10
 
 sort_mode = 'total'
 
+# Messages with a link to one of these domains count as links.  A shared link counts if its host is one of them or a subdomain of one,
+# so 'imgur.com' also counts shares of i.imgur.com pictures
+link_domains = ['imgur.com']
+
+# The length of the periods the history is split up in.  One of GRANULARITIES
+granularity = 'month'
+
+# Graphs switch to longer periods than `granularity` until no trace has more points than this.  0 for no limit
+max_points_per_trace = 500
+
+# Where the computed per-conversation aggregates get saved so unchanged conversations don't have to be parsed again
+cache_dir = './.analysis-cache'
+use_cache = True
+# Ignore existing cache entries, but still write new ones
+rebuild_cache = False
+# Keep the analysis of each conversation by folder name and only add the messages newer than the last run
+incremental = False
+
+# Whether group conversations, with more than two participants, are analyzed along with the two-person ones
+include_groups = False
+
+# Whether the words of each side of a conversation are fed into the sketches of `--vocabulary`
+vocabulary_sketches = False
+
+# Files up to this many bytes are decoded in one go instead of streamed one message at a time, which is faster but keeps
+# the whole file in memory.  Only done for `--summary-only`
+whole_file_size = 0
+
+# Only the messages from `since_ms` up to, but not including, `until_ms` are analyzed.  None for no limit
+since_ms = None
+until_ms = None
+
 filtered_list = []
 
 
@@ -47,8 +100,42 @@ END = '\033[0m'
 
 TOTAL_MESSAGES_SORT_MODE = 'total'
 WORDS_SORT_MODE = 'num_words'
-IMGUR_LINKS_SORT_MODE = 'imgur'
+LINKS_SORT_MODE = 'links'
 OLDEST_SORT_MODE = 'oldest'
+DISTINCT_WORDS_SORT_MODE = 'distinct_words'
+# Older names of the sort modes that are still accepted
+SORT_MODE_ALIASES = {'imgur': LINKS_SORT_MODE}
+
+DAY_GRANULARITY = 'day'
+WEEK_GRANULARITY = 'week'
+MONTH_GRANULARITY = 'month'
+QUARTER_GRANULARITY = 'quarter'
+YEAR_GRANULARITY = 'year'
+# From shortest to longest
+GRANULARITIES = [DAY_GRANULARITY, WEEK_GRANULARITY, MONTH_GRANULARITY, QUARTER_GRANULARITY, YEAR_GRANULARITY]
+
+HTML_RENDER_FORMAT = 'html'
+JSON_RENDER_FORMAT = 'json'
+RENDER_FORMATS = [HTML_RENDER_FORMAT, JSON_RENDER_FORMAT]
+# Written once per render directory and shared by all the html files in it
+PLOTLY_JS_FILE = 'plotly.min.js'
+
+# No message in an export can take fewer bytes than `{"sender_name":"","timestamp_ms":0}`
+MIN_MESSAGE_BYTES = 32
+# Conversations with fewer bytes than this per message of `is_worth_including_threshold` have their messages counted before they are parsed
+PREFILTER_COUNT_BYTES_PER_MESSAGE = 2048
+# Only shows up once per message, as other keys use names like `creation_timestamp`
+MESSAGE_COUNT_KEY = b'"timestamp_ms"'
+
+HOUR_MS = 60 * 60 * 1000
+DAY_MS = 24 * HOUR_MS
+
+# Bump whenever the format of the cached aggregates, or how they are counted, changes
+CACHE_VERSION = 10
+
+# Saved in `cache_dir`, along with a key of the conversations and settings it was built from
+TIMELINE_FILE = 'timeline.npz'
+SEARCH_INDEX_FILE = 'search_index.npz'
 
 SORT_CONFIGS = {
 	TOTAL_MESSAGES_SORT_MODE: {
@@ -66,11 +153,16 @@ SORT_CONFIGS = {
 		'sort_func': lambda conversation: conversation.summary.oldest_message_time,
 		'reverse': False,
 	},
-	IMGUR_LINKS_SORT_MODE: {
-		'type': 'Imgur',
-		'sort_func': lambda conversation: conversation.summary.imgur_links,
+	LINKS_SORT_MODE: {
+		'type': 'Links',
+		'sort_func': lambda conversation: conversation.summary.num_links,
 		'reverse': True,
 	},	
+	DISTINCT_WORDS_SORT_MODE: {
+		'type': 'Distinct Words',
+		'sort_func': lambda conversation: conversation.distinct_words(),
+		'reverse': True,
+	},
 }
 
 ###########################################################################
@@ -80,52 +172,140 @@ class Conversation(object):
 	High-level wrapper class that holds information about messages,
 	convenience functions, and objects that hold logic for different parts of the script
 	"""
-	def __init__(self, messages):
-
-
-		self.messages = [Message(self, **message) for message in messages]
-
-		self.summary = ConversationSummary(self.messages)
-		self.history = ConversationHistory(self.messages)
-
+	def __init__(self, store, summary=None, history=None):
+		"""
+		Builds the conversation from its MessageStore
+		The summary and history are only given when they were loaded from the cache
+		Without one, the history is built from the store the first time it is used, since only the top conversations are ever displayed
+		"""
+		self.store = store
+		self.summary = summary if summary is not None else ConversationSummary(store)
+		self._history = history
+		# Built on first use by `starts_index`
+		self._starts_index = None
+		# Histories with other periods than the granularity, built on first use by `history_per`
+		self._histories_per_period = {}
+		# Built on first use by `participants`
+		self._participants = None
+		self._set_other_person()
+
+	def _set_other_person(self):
 		# Just a convenience attribute so we don't have to reference the summary's other person
 		self.other_person = self.summary.other_person
 
 		self.header_str = '{bold}{blue}{name}{end}'.format(bold=BOLD, blue=BLUE, name=self.other_person, end=END)
 
+	def add_newer_messages(self, newer_store):
+		"""Merges in a store of messages that are all newer than the ones already in the conversation"""
+		self.summary.add_newer(ConversationSummary(newer_store))
+		if self._history is not None:
+			self._history.add(ConversationHistory(newer_store))
+		self.store.prepend(newer_store)
+		self._starts_index = None
+		self._histories_per_period = {}
+		self._participants = None
+		self._set_other_person()
+
+	@property
+	def history(self):
+		if self._history is None:
+			self._history = ConversationHistory(self.store)
+		return self._history
+
+	def history_per(self, period):
+		"""The history split up in `period`s, which can be longer than the configured granularity"""
+		if period == self.history.granularity:
+			return self.history
+		if period not in self._histories_per_period:
+			self._histories_per_period[period] = ConversationHistory(self.store, period=period)
+		return self._histories_per_period[period]
+
+	def has_history(self):
+		"""Whether the history was built or loaded, rather than still waiting for its first use"""
+		return self._history is not None
+
+	def starts_index(self):
+		if self._starts_index is None:
+			self._starts_index = ConversationStartsIndex(self.store)
+		return self._starts_index
+
+	def participants(self):
+		if self._participants is None:
+			self._participants = ParticipantStats(self.store)
+		return self._participants
+
+	def distinct_words(self):
+		"""The estimated number of distinct words both sides wrote.  0 if the words were not sketched"""
+		vocabulary = self.store.vocabulary
+		if vocabulary is None:
+			return 0
+		return HyperLogLog(registers=np.maximum(vocabulary['me'].distinct.registers, vocabulary['other'].distinct.registers)).estimate()
+
+	def window(self, since=None, until=None):
+		"""A conversation of only the messages from `since` up to, but not including, `until` (timestamp_ms, None for no limit)"""
+		return Conversation(self.store.window(since, until))
+
 	def __str__(self):
 		return str(self.summary)
 
+	def to_cache_dict(self):
+		return {
+			'store': self.store.to_cache_dict(),
+			'summary': self.summary.to_cache_dict(),
+			# Only saved if it was needed, otherwise it is built from the cached store when it is
+			'history': self._history.to_cache_dict() if self._history is not None else None,
+		}
+
+	@classmethod
+	def from_cache_dict(cls, data):
+		# The history is cheap to recompute from the store, so it is only reused if it was made with the same granularity
+		history = None
+		if data['history'] is not None and data['history']['granularity'] == granularity:
+			history = ConversationHistory.from_cache_dict(data['history'])
+		return cls(MessageStore.from_cache_dict(data['store']), summary=ConversationSummary.from_cache_dict(data['summary']), history=history)
+
 	def message_history_str(self):
 		return self.header_str + str(self.history)
 
 	def words_history_str(self):
 		return self.header_str + str(self.history.words_month_str())
 
-	def messages_history_bar_obj(self):
-		return self._create_bar_on_history_map(self.history.messages_month_map())
+	def messages_history_bar_obj(self, period=None):
+		history = self._graphed_history(period)
+		return self._create_bar_on_history_map(history.messages_month_map(), history)
+
+	def words_history_bar_obj(self, period=None):
+		history = self._graphed_history(period)
+		return self._create_bar_on_history_map(history.words_month_map(), history)
 
-	def words_history_bar_obj(self):
-		return self._create_bar_on_history_map(self.history.words_month_map())
+	def call_history_bar_obj(self, period=None):
+		history = self._graphed_history(period)
+		return self._create_bar_on_history_map(history.calls_month_map(), history)
 
-	def call_history_bar_obj(self):
-		return self._create_bar_on_history_map(self.history.calls_month_map())
+	def call_duration_history_bar_obj(self, period=None):
+		history = self._graphed_history(period)
+		return self._create_bar_on_history_map(history.call_duration_month_map(), history)
 
-	def call_duration_history_bar_obj(self):
-		return self._create_bar_on_history_map(self.history.call_duration_month_map())
+	def _graphed_history(self, period):
+		return self.history if period is None else self.history_per(period)
 
-	def _create_bar_on_history_map(self, history_map):
-		return go.Bar(name=self.other_person, x=self.history.message_dates, y=[history_map[month] for month in self.history.message_dates])
+	def _create_bar_on_history_map(self, history_map, history):
+		import graphs
+		# Only periods with messages get a bar, a date axis leaves the rest empty
+		return graphs.history_bar(self.other_person, history.message_dates, [history_map[month] for month in history.message_dates])
 
-	def messages_history_relative_line_obj(self):
-		return self._create_relative_line_on_history_map(self.history.messages_month_map())
+	def messages_history_relative_line_obj(self, period=None):
+		history = self._graphed_history(period)
+		return self._create_relative_line_on_history_map(history.messages_month_map(), history)
 
-	def words_history_relative_line_obj(self):
-		return self._create_relative_line_on_history_map(self.history.words_month_map())
+	def words_history_relative_line_obj(self, period=None):
+		history = self._graphed_history(period)
+		return self._create_relative_line_on_history_map(history.words_month_map(), history)
 
-	def _create_relative_line_on_history_map(self, history_map):
-		return go.Scatter(name=self.other_person, x=self.history.message_dates, y=[history_map[month] for month in self.history.message_dates],
-			mode='lines', stackgroup='one', groupnorm='percent')
+	def _create_relative_line_on_history_map(self, history_map, history):
+		import graphs
+		# Periods without messages are left out too.  The stack group counts them as zero
+		return graphs.history_relative_line(self.other_person, history.message_dates, [history_map[month] for month in history.message_dates])
 
 	def number_conversation_starts(self, hour_threshold=72, count_links=True):
 		"""
@@ -147,17 +327,12 @@ class Conversation(object):
 			convo_starts[my_links] = 0
 			convo_starts[other_links] = 0
 
-		for i in range(1, len(self.messages)):
-			time_diff = (self.messages[i-1].time - self.messages[i].time).total_seconds() / 3600
-			if time_diff >= hour_threshold:
-				if self.messages[i].sent_by_me():
-					convo_starts[my_facebook_name] += 1
-					if count_links and self.messages[i].imgur_links_in_message() > 0:
-						convo_starts[my_links] += 1
-				else:
-					convo_starts[self.other_person] += 1
-					if count_links and self.messages[i].imgur_links_in_message() > 0:
-						convo_starts[other_links] += 1
+		starts = self.starts_index().count_starts([hour_threshold])
+		convo_starts[my_facebook_name] = starts['me'][0]
+		convo_starts[self.other_person] = starts['other'][0]
+		if count_links:
+			convo_starts[my_links] = starts['me_links'][0]
+			convo_starts[other_links] = starts['other_links'][0]
 
 		return convo_starts
 
@@ -165,48 +340,153 @@ class Conversation(object):
 
 ###########################################################################
 
-class ConversationSummary(object):
+class ConversationStartsIndex(object):
 	"""
-	Holds summary data around a conversation
+	The gap in hours before every message, split up by who sent it and whether it had a link, and sorted
+	Answers how many conversations were started after any hour threshold, or a whole list of them, with a binary search per threshold
 	"""
-	def __init__(self, messages):
-		self.other_person = ''
-		for message in messages:
-			if not message.sent_by_me():
-				self.other_person = message.sender_name
-				break
+	# Keys of the counts
+	GROUPS = ['me', 'other', 'me_links', 'other_links']
+
+	def __init__(self, store):
+		timestamps = np.frombuffer(store.timestamps, dtype=np.int64)
+		# Gaps are measured in local time, like the differences of `datetime.fromtimestamp` would be
+		local_ms = timestamps + _local_utc_offsets_ms(timestamps)
+		# Messages are newest first. A gap counts for the older message of the pair
+		gap_hours = (local_ms[:-1] - local_ms[1:]) / 1000 / 3600
+		sent_by_me = np.frombuffer(store.sent_by_me, dtype=np.uint8)[1:].astype(bool)
+		has_links = np.frombuffer(store.links, dtype=np.uint8)[1:] > 0
+
+		self.sorted_gaps = {
+			'me': np.sort(gap_hours[sent_by_me]),
+			'other': np.sort(gap_hours[~sent_by_me]),
+			'me_links': np.sort(gap_hours[sent_by_me & has_links]),
+			'other_links': np.sort(gap_hours[~sent_by_me & has_links]),
+		}
 
-		self.total_messages = len(messages)
-		self.my_total_messages = 0
-		self.my_actual_messages = 0
-		self.other_messages = 0
-		self.imgur_links = 0
-		self.num_words = 0
-		self.num_calls = 0
-
-		for message in messages:
-			if message.sent_by_me():
-				self.my_total_messages += 1
-				num_links = message.imgur_links_in_message()
-				self.imgur_links += num_links
-				if num_links == 0:
-					self.my_actual_messages += 1
-			else:
-				self.other_messages += 1
+	def count_starts(self, hour_thresholds):
+		"""
+		Returns a dict with a list for each of GROUPS, holding the number of messages sent after a gap of at least each threshold
+		"""
+		thresholds = np.asarray(hour_thresholds, dtype=np.float64)
+		counts = {}
+		for group in self.GROUPS:
+			gaps = self.sorted_gaps[group]
+			counts[group] = (len(gaps) - np.searchsorted(gaps, thresholds, side='left')).tolist()
+		return counts
+
+
+
+###########################################################################
+
+class ParticipantStats(object):
+	"""
+	Totals and history of every sender in a conversation, indexed by the sender ids the MessageStore interned
+	Each counter is one array with an entry per sender, and each history one (senders x periods) array, rather than a dict per sender
+	per period, so threads with hundreds of participants and millions of messages stay small
+	The totals are counted like the ConversationSummary's.  The history is split up in the granularity
+	"""
+	def __init__(self, store):
+		self.names = list(store.senders)
+		num_senders = len(self.names)
+		sender_ids = np.frombuffer(store.sender_ids, dtype=np.uint32).astype(np.intp)
+		word_counts = np.frombuffer(store.word_counts, dtype=np.int64)
+		call_durations = np.frombuffer(store.call_durations, dtype=np.int64)
+
+		# Words including the spoken words of calls, if those count
+		words = word_counts.astype(np.float64)
+		if include_call_words:
+			is_call = call_durations > -1
+			words[is_call] += call_speak_rate * call_durations[is_call]
+
+		self.num_messages = np.bincount(sender_ids, minlength=num_senders)
+		self.num_words = np.bincount(sender_ids, weights=words, minlength=num_senders)
+		self.num_links = np.bincount(sender_ids, weights=np.frombuffer(store.links, dtype=np.uint8), minlength=num_senders).astype(np.int64)
+		self.num_calls = np.bincount(sender_ids[call_durations > min_call_duration_length], minlength=num_senders)
 
-			self.num_words += message.words_in_message(include_call_words)
+		# One flat bincount fills the whole (senders x periods) array
+		(self.periods, codes) = period_bins(np.frombuffer(store.timestamps, dtype=np.int64), granularity)
+		num_periods = len(self.periods)
+		cells = sender_ids * num_periods + codes
+		self.period_num_messages = np.bincount(cells, minlength=num_senders * num_periods).reshape(num_senders, num_periods)
+		self.period_num_words = np.bincount(cells, weights=words, minlength=num_senders * num_periods).reshape(num_senders, num_periods)
 
-			if message.is_call() and message.call_duration > min_call_duration_length:
-				self.num_calls += 1
+	def __len__(self):
+		return len(self.names)
 
-		self.newest_message_time = messages[0].time
-		self.oldest_message_time = messages[-1].time
+	def by_messages(self):
+		"""The sender ids, the ones who sent the most messages first and ties by name"""
+		return sorted(range(len(self.names)), key=lambda sender_id: (-self.num_messages[sender_id], self.names[sender_id]))
+
+	def words(self, sender_id):
+		# Whole numbers, unless the spoken words of calls are added
+		return float(self.num_words[sender_id]) if include_call_words else int(self.num_words[sender_id])
+
+
+
+###########################################################################
+
+class ConversationSummary(object):
+	"""
+	Holds summary data around a conversation
+	"""
+	# The counts that add up when messages are added
+	COUNTERS = ['total_messages', 'my_total_messages', 'my_actual_messages', 'other_messages', 'num_links', 'num_words', 'num_calls']
+	# Attributes that are saved in the analysis cache.  Everything else is derived from them
+	CACHED_ATTRIBUTES = ['other_person'] + COUNTERS + ['newest_timestamp_ms', 'oldest_timestamp_ms', 'is_group']
+
+	def __init__(self, store=None):
+		if store is None:
+			# Filled in by `from_cache_dict`
+			return
+
+		# The counters were already totalled up while the store was filled
+		for (attr, value) in store.totals.items():
+			setattr(self, attr, value)
+		# Group conversations go by their title, as there is no single other person
+		self.other_person = store.group_title or store.other_person
+		self.is_group = bool(store.group_title)
+		self.total_messages = len(store)
+		self.other_messages = self.total_messages - self.my_total_messages
+
+		self.newest_timestamp_ms = store.timestamps[0]
+		self.oldest_timestamp_ms = store.timestamps[-1]
+		self._compute_derived()
+
+	def _compute_derived(self):
+		self.newest_message_time = datetime.fromtimestamp(self.newest_timestamp_ms/1000)
+		self.oldest_message_time = datetime.fromtimestamp(self.oldest_timestamp_ms/1000)
 		# Should probably filter out some outliers
 		self.days_spoken = (self.newest_message_time - self.oldest_message_time).days
 		self.average_msg_per_day = self.total_messages / (float(self.days_spoken) if self.days_spoken else 1)
 		self.avg_calls_per_month = self.num_calls / (float(self.days_spoken / 30) if self.days_spoken else 1)
 
-
+	def add_newer(self, newer):
+		"""Adds the counts of a summary of messages that are all newer than the ones in this one"""
+		for attr in self.COUNTERS:
+			setattr(self, attr, getattr(newer, attr) + getattr(self, attr))
+		self.other_person = newer.other_person or self.other_person
+		self.newest_timestamp_ms = newer.newest_timestamp_ms
+		self._compute_derived()
+
+	def to_cache_dict(self):
+		return {attr: getattr(self, attr) for attr in self.CACHED_ATTRIBUTES}
+
+	def to_json_dict(self):
+		"""The cached and derived values, with the times as ISO strings"""
+		data = self.to_cache_dict()
+		for attr in ['newest_message_time', 'oldest_message_time'] + EXPORTED_SUMMARY_ATTRIBUTES:
+			value = getattr(self, attr)
+			data[attr] = value.isoformat(' ') if isinstance(value, datetime) else value
+		return data
+
+	@classmethod
+	def from_cache_dict(cls, data):
+		summary = cls()
+		for attr in cls.CACHED_ATTRIBUTES:
+			setattr(summary, attr, data[attr])
+		summary._compute_derived()
+		return summary
 
 	def __str__(self):
 		return """
@@ -215,7 +495,7 @@ class ConversationSummary(object):
 	{green}{underline}Total Words Written:{end}  {bold}{words}{end}
 	{green}{underline}My Total Messages:{end}    {bold}{mine}{end}
 	{green}{underline}Number of Calls:{end}      {bold}{calls}{end}
-	{green}{underline}My Imgur Links:{end}       {bold}{imgur}{end}
+	{green}{underline}My Links:{end}             {bold}{links}{end}
 	{green}{underline}My Actual Messages:{end}   {bold}{mine_actual}{end}
 	{green}{underline}Other Messages:{end}       {bold}{other}{end}
 	{green}{underline}Oldest Message:{end}       {bold}{oldest}{end}
@@ -225,7 +505,7 @@ class ConversationSummary(object):
 	{green}{underline}Avg Calls Per Month: {end} {bold}{avg_calls}{end}
 		""".format(bold=BOLD, green=GREEN, blue=BLUE, underline=UNDERLINE, end=END, 
 			name=self.other_person,
-			total=self.total_messages, words=self.num_words, mine=self.my_total_messages, calls=self.num_calls, imgur=self.imgur_links, mine_actual=self.my_actual_messages, other=self.other_messages,
+			total=self.total_messages, words=self.num_words, mine=self.my_total_messages, calls=self.num_calls, links=self.num_links, mine_actual=self.my_actual_messages, other=self.other_messages,
 			oldest=self.oldest_message_time, newest=self.newest_message_time, days=self.days_spoken, avg=self.average_msg_per_day, avg_calls=self.avg_calls_per_month).strip()
 
 
@@ -234,75 +514,120 @@ class ConversationSummary(object):
 class ConversationHistory(object):
 	"""
 	Class that holds history information around a conversation
+	The history is split up in months by default.  With another `granularity` the 'month' keys are days, weeks, quarters or years instead
+	`period` overrides the granularity for this history only
 	"""
 
-	def __init__(self, messages):
-		# A dict that holds references to message object based on the month was sent in
-		# Key is string 'YYYY-MM'
-		self.monthly_messages = {}
-		# dict that holds specifically call-messages same as above messages
-		self.monthly_calls = {}
-
-		for message in messages:
-			year_month = message.year_month()
-			if self.monthly_messages.get(year_month):
-				self.monthly_messages[year_month].append(message)
-			else:
-				self.monthly_messages[year_month] = [message]
-
-			if message.is_call() and message.call_duration >= min_call_duration_length:
-				if self.monthly_calls.get(year_month):
-					self.monthly_calls[year_month].append(message)
-				else:
-					self.monthly_calls[year_month] = [message]
-
-
+	def __init__(self, store=None, period=None):
+		# Dicts that hold the totals for each month the messages were sent in
+		# Key is string 'YYYY-MM' ('YYYY-MM-DD' for days and the monday of weeks, the first month for quarters, 'YYYY' for years)
+		self.monthly_num_messages = {}
+		self.monthly_num_words = {}
+		# These only count call-messages
+		self.monthly_num_calls = {}
+		self.monthly_call_duration = {}
+		self.granularity = period if period is not None else granularity
+
+		if store is not None and len(store):
+			self._aggregate(store)
+
+		self._sort_dates()
+
+	def _aggregate(self, store):
+		"""Computes all the totals in one vectorized pass over the store's columns"""
+		keys, codes = period_bins(np.frombuffer(store.timestamps, dtype=np.int64), self.granularity)
+		num_periods = len(keys)
+		word_counts = np.frombuffer(store.word_counts, dtype=np.int64)
+		call_durations = np.frombuffer(store.call_durations, dtype=np.int64)
+
+		num_messages = np.bincount(codes, minlength=num_periods)
+		# Weighted bincount sums as float64, which is exact for anything below 2**53
+		num_words = np.bincount(codes, weights=word_counts, minlength=num_periods).astype(np.int64).tolist()
+
+		is_call = call_durations > -1
+		if include_call_words and is_call.any():
+			call_codes = codes[is_call]
+			call_words = np.bincount(call_codes, weights=call_speak_rate * call_durations[is_call], minlength=num_periods)
+			for idx in np.unique(call_codes).tolist():
+				num_words[idx] += float(call_words[idx])
+
+		counted_calls = is_call & (call_durations >= min_call_duration_length)
+		call_codes = codes[counted_calls]
+		num_calls = np.bincount(call_codes, minlength=num_periods)
+		call_duration = np.bincount(call_codes, weights=call_durations[counted_calls], minlength=num_periods).astype(np.int64)
+
+		self.monthly_num_messages = dict(zip(keys, num_messages.tolist()))
+		self.monthly_num_words = dict(zip(keys, num_words))
+		self.monthly_num_calls = dict(zip(keys, num_calls.tolist()))
+		self.monthly_call_duration = dict(zip(keys, call_duration.tolist()))
+
+	def add(self, other):
+		"""Adds the totals of another history with the same granularity"""
+		for (totals, other_totals) in [(self.monthly_num_messages, other.monthly_num_messages), (self.monthly_num_words, other.monthly_num_words),
+				(self.monthly_num_calls, other.monthly_num_calls), (self.monthly_call_duration, other.monthly_call_duration)]:
+			for (month, value) in other_totals.items():
+				totals[month] = value + totals.get(month, 0)
+		self._sort_dates()
+
+	def _sort_dates(self):
 		# Get all the year-month keys in a sorted order
-		self.message_dates = sorted(self.monthly_messages.keys(), key=lambda year_month: year_month)
+		self.message_dates = sorted(self.monthly_num_messages.keys(), key=lambda year_month: year_month)
+
+	def to_cache_dict(self):
+		return {
+			'granularity': self.granularity,
+			'messages': self.monthly_num_messages,
+			'words': self.monthly_num_words,
+			'calls': self.monthly_num_calls,
+			'call_duration': self.monthly_call_duration,
+		}
+
+	@classmethod
+	def from_cache_dict(cls, data):
+		history = cls()
+		history.granularity = data['granularity']
+		history.monthly_num_messages = data['messages']
+		history.monthly_num_words = data['words']
+		history.monthly_num_calls = data['calls']
+		history.monthly_call_duration = data['call_duration']
+		history._sort_dates()
+		return history
 
 	def num_messages_for_month(self, yyyy_mm):
-		return len(self.monthly_messages.get(yyyy_mm, []))
+		return self.monthly_num_messages.get(yyyy_mm, 0)
 
 	def num_calls_for_month(self, yyyy_mm):
-		return len(self.monthly_calls.get(yyyy_mm, []))
+		return self.monthly_num_calls.get(yyyy_mm, 0)
 
 	def num_words_for_month(self, yyyy_mm):
-		messages = self.monthly_messages.get(yyyy_mm, [])
-		num_words = 0
-		for message in messages:
-			num_words += message.words_in_message(include_call_words)
-		return num_words
+		return self.monthly_num_words.get(yyyy_mm, 0)
 
 	def call_duration_for_month(self, yyyy_mm):
-		messages = self.monthly_calls.get(yyyy_mm, [])
-		call_duration = 0
-		for message in messages:
-			call_duration += message.call_duration
-		return call_duration
+		return self.monthly_call_duration.get(yyyy_mm, 0)
 
 
 	def messages_month_map(self):
-		"""Maps monthly_messages into number of messages sent each month"""
+		"""Maps the monthly totals into number of messages sent each month"""
 		return self._map(lambda month: self.num_messages_for_month(month))
 
 	def words_month_map(self):
-		"""Maps monthly_messages into number of words sent each month"""
+		"""Maps the monthly totals into number of words sent each month"""
 		return self._map(lambda month: self.num_words_for_month(month))
 
 	def calls_month_map(self):
-		"""Maps monthly_calls into number of calls sent each month"""
+		"""Maps the monthly call totals into number of calls sent each month"""
 		return self._map(lambda month: self.num_calls_for_month(month))
 
 	def call_duration_month_map(self):
-		"""Maps monthly_calls into duration of calls each month"""
+		"""Maps the monthly call totals into duration of calls each month"""
 		return self._map(lambda month: self.call_duration_for_month(month))
 
 	def words_per_message_month_map(self):
-		"""Maps monthly_messages into number of words per message sent each month"""
+		"""Maps the monthly totals into number of words per message sent each month"""
 		return self._map(lambda month: self.num_words_for_month(month) / self.num_messages_for_month(month))
 
 	def _map(self, map_func):
-		"""Maps monthly-messages according to the map-function"""
+		"""Maps the months according to the map-function"""
 		mapped_msgs = {}
 		for month in self.message_dates:
 			mapped_msgs[month] = map_func(month)
@@ -328,75 +653,441 @@ class ConversationHistory(object):
 
 ###########################################################################
 
-class Message(object):
+class MessageStore(object):
 	"""
-	Class that holds data on a message as well as helper and logic functions
+	Columnar storage of the per-message data the analysis needs, one entry per message, newest first
+	Keeps a few bytes per message instead of an object per message, so exports with millions of messages fit in memory
+	The message content is not kept. `sources` has the json files the messages came from, to read them again when needed
 	"""
-	def __init__(self, conversation, **kwargs):
-		# A self-reference to the overall conversation for convenience
-		self.conversation = conversation
-
-		# We want the message to die if it doesn't have these kwargs
-		self.time = datetime.fromtimestamp(kwargs['timestamp_ms']/1000)
-		self.sender = kwargs['sender_name']
-
-		# Somehow, a message can not have the content key
-		self.content = kwargs.get('content', '')
-
-		self.call_duration = kwargs.get('call_duration', -1)
-
-		for k in kwargs:
-			setattr(self, k, kwargs[k])
+	COLUMNS = ['timestamps', 'sent_by_me', 'sender_ids', 'word_counts', 'call_durations', 'links']
+
+	def __init__(self):
+		# timestamp_ms of each message
+		self.timestamps = array('q')
+		# 1 if sent by me, 0 otherwise
+		self.sent_by_me = bytearray()
+		# Index of the sender in `senders`
+		self.sender_ids = array('I')
+		# Words in the content. 0 for calls, as their words depend on `include_call_words`
+		self.word_counts = array('q')
+		# -1 if the message is not a call
+		self.call_durations = array('q')
+		# 1 if the message has a link to one of `link_domains` in it, 0 otherwise
+		self.links = bytearray()
+
+		# The sender of the first message not sent by me
+		self.other_person = ''
+		# The thread title of a group conversation.  Empty for conversations between two people
+		self.group_title = ''
+		# Every sender, in the order their first message was added.  Each name is stored once however many messages they sent
+		self.senders = []
+		self._sender_ids = {}
+		# [file_path, number of messages] for each file the messages were read from, in order
+		self.sources = []
+		# WordSketches of the words I wrote and the others wrote, if `vocabulary_sketches` is on
+		self.vocabulary = None
+		# Running totals for the ConversationSummary, kept up to date while the columns are filled
+		self.totals = {
+			'my_total_messages': 0,
+			'my_actual_messages': 0,
+			'num_links': 0,
+			'num_words': 0,
+			'num_calls': 0,
+		}
 
-	
-	def sent_by_me(self):
-		return self.sender_name == my_facebook_name
+	def __len__(self):
+		return len(self.timestamps)
 
-	def year_month(self):
-		return self.time.strftime('%Y-%m')
+	def add_messages(self, raw_messages, file_path):
+		"""
+		Appends the raw message dicts from one json file, without keeping the dicts around
+		This is the only pass over the messages: the columns, word counts, links and summary totals are all filled in here
+		"""
+		num_before = len(self)
+		totals = self.totals
+		my_total_messages = totals['my_total_messages']
+		my_actual_messages = totals['my_actual_messages']
+		my_links = totals['num_links']
+		num_words = totals['num_words']
+		num_calls = totals['num_calls']
+
+		# Bound once, as these get called for every message
+		append_timestamp = self.timestamps.append
+		append_sent_by_me = self.sent_by_me.append
+		append_sender_id = self.sender_ids.append
+		senders = self.senders
+		sender_ids = self._sender_ids
+		append_word_count = self.word_counts.append
+		append_call_duration = self.call_durations.append
+		append_link = self.links.append
+		(match_share, search_content) = link_matchers(tuple(link_domains))
+		# The texts of this file only, which are counted and folded into the sketches at the end
+		(my_texts, other_texts) = ([], []) if vocabulary_sketches else (None, None)
+
+		for raw_message in raw_messages:
+			sender_name = raw_message['sender_name']
+			sender_id = sender_ids.get(sender_name)
+			if sender_id is None:
+				sender_id = sender_ids[sender_name] = len(senders)
+				senders.append(sender_name)
+			content = raw_message.get('content', '')
+			call_duration = raw_message.get('call_duration', -1)
+			sent_by_me = sender_name == my_facebook_name
+			share = raw_message.get('share')
+			link = 1 if (share and match_share(share.get('link') or '')) or search_content(content) else 0
+
+			if sent_by_me:
+				my_total_messages += 1
+				my_links += link
+				if link == 0:
+					my_actual_messages += 1
+			elif not self.other_person:
+				self.other_person = sender_name
+
+			if call_duration > -1:
+				word_count = 0
+				if include_call_words:
+					num_words += call_speak_rate * call_duration
+				if call_duration > min_call_duration_length:
+					num_calls += 1
+			else:
+				word_count = count_words(content)
+				num_words += word_count
+				if my_texts is not None:
+					(my_texts if sent_by_me else other_texts).append(content)
+
+			append_timestamp(raw_message['timestamp_ms'])
+			append_sent_by_me(sent_by_me)
+			append_sender_id(sender_id)
+			append_word_count(word_count)
+			append_call_duration(call_duration)
+			append_link(link)
+
+		totals['my_total_messages'] = my_total_messages
+		totals['my_actual_messages'] = my_actual_messages
+		totals['num_links'] = my_links
+		totals['num_words'] = num_words
+		totals['num_calls'] = num_calls
+		self.sources.append([file_path, len(self) - num_before])
+		if my_texts is not None:
+			if self.vocabulary is None:
+				self.vocabulary = {'me': WordSketch(), 'other': WordSketch()}
+			# Tokenized in one go, which is a lot faster than message by message
+			self.vocabulary['me'].add_counts(Counter(tokenize('\n'.join(my_texts))))
+			self.vocabulary['other'].add_counts(Counter(tokenize('\n'.join(other_texts))))
+
+	def prepend(self, newer):
+		"""Puts the messages of another store, which are all newer than the ones in this one, in front of them"""
+		# The newer store interned its senders on its own, so its ids are mapped onto the ones of this store, adding the senders it doesn't have
+		id_map = np.array([self._sender_id(name) for name in newer.senders], dtype=np.uint32)
+		newer_sender_ids = array('I', id_map[np.frombuffer(newer.sender_ids, dtype=np.uint32)].tobytes())
+		for column in self.COLUMNS:
+			newer_column = newer_sender_ids if column == 'sender_ids' else getattr(newer, column)
+			setattr(self, column, newer_column + getattr(self, column))
+		for (key, value) in newer.totals.items():
+			self.totals[key] = value + self.totals[key]
+		self.other_person = newer.other_person or self.other_person
+		self.group_title = newer.group_title or self.group_title
+		self.sources = newer.sources + self.sources
+		if self.vocabulary is None:
+			self.vocabulary = newer.vocabulary
+		elif newer.vocabulary is not None:
+			for (side, sketch) in newer.vocabulary.items():
+				self.vocabulary[side].merge(sketch)
+
+	def window(self, since=None, until=None):
+		"""
+		A store of only the messages from `since` up to, but not including, `until` (timestamp_ms, None for no limit), found with binary searches
+		The totals are counted again from the columns.  It can't read its raw messages again, as it only holds part of the files,
+		and it has no vocabulary, as the sketches can't be cut down to a time window
+		"""
+		# The messages are newest first, so the negated timestamps are sorted
+		negated = -np.frombuffer(self.timestamps, dtype=np.int64)
+		start = 0 if until is None else int(np.searchsorted(negated, -until, side='right'))
+		stop = len(self) if since is None else int(np.searchsorted(negated, -since, side='right'))
+
+		store = MessageStore()
+		for column in self.COLUMNS:
+			setattr(store, column, getattr(self, column)[start:stop])
+		store.other_person = self.other_person
+		store.group_title = self.group_title
+		store.senders = list(self.senders)
+		store._sender_ids = dict(self._sender_ids)
+
+		sent_by_me = np.frombuffer(store.sent_by_me, dtype=np.uint8).astype(bool)
+		links = np.frombuffer(store.links, dtype=np.uint8).astype(bool)
+		call_durations = np.frombuffer(store.call_durations, dtype=np.int64)
+		is_call = call_durations > -1
+		store.totals = {
+			'my_total_messages': int(sent_by_me.sum()),
+			'my_actual_messages': int((sent_by_me & ~links).sum()),
+			'num_links': int((sent_by_me & links).sum()),
+			'num_words': int(np.frombuffer(store.word_counts, dtype=np.int64).sum()),
+			'num_calls': int((call_durations > min_call_duration_length).sum()),
+		}
+		if include_call_words and is_call.any():
+			for call_duration in call_durations[is_call].tolist():
+				store.totals['num_words'] += call_speak_rate * call_duration
+		return store
+
+	def _sender_id(self, name):
+		if name not in self._sender_ids:
+			self._sender_ids[name] = len(self.senders)
+			self.senders.append(name)
+		return self._sender_ids[name]
+
+	def to_cache_dict(self):
+		return {
+			'timestamps': _encode_column(self.timestamps),
+			'sent_by_me': _encode_column(self.sent_by_me),
+			'sender_ids': _encode_column(self.sender_ids),
+			'word_counts': _encode_column(self.word_counts),
+			'call_durations': _encode_column(self.call_durations),
+			'links': _encode_column(self.links),
+			'other_person': self.other_person,
+			'group_title': self.group_title,
+			'senders': self.senders,
+			'sources': self.sources,
+			'totals': self.totals,
+			'vocabulary': {side: sketch.to_cache_dict() for (side, sketch) in self.vocabulary.items()} if self.vocabulary is not None else None,
+		}
 
-	# Types of messages:  Generic, Share, Call
-	# Generic messages can have links in them or can be gifs/photos/stickers
-	# Shares can have content assocaited with them
-	# Calls have a duration	
+	@classmethod
+	def from_cache_dict(cls, data):
+		store = cls()
+		store.timestamps.frombytes(_decode_column(data['timestamps']))
+		store.sent_by_me = bytearray(_decode_column(data['sent_by_me']))
+		store.sender_ids.frombytes(_decode_column(data['sender_ids']))
+		store.word_counts.frombytes(_decode_column(data['word_counts']))
+		store.call_durations.frombytes(_decode_column(data['call_durations']))
+		store.links = bytearray(_decode_column(data['links']))
+		store.other_person = data['other_person']
+		store.group_title = data['group_title']
+		store.senders = data['senders']
+		store._sender_ids = {name: sender_id for (sender_id, name) in enumerate(store.senders)}
+		store.sources = data['sources']
+		store.totals = data['totals']
+		if data['vocabulary'] is not None:
+			store.vocabulary = {side: WordSketch.from_cache_dict(sketch) for (side, sketch) in data['vocabulary'].items()}
+		return store
+
+
+def _encode_column(column):
+	return base64.b64encode(bytes(column)).decode('ascii')
+
+def _decode_column(encoded):
+	return base64.b64decode(encoded)
 
-	def is_call(self):
-		return self.call_duration > -1
+###########################################################################
 
+class TimelineIndex(object):
+	"""
+	Every message of every conversation in one table sorted by time: its timestamp_ms, the index of its conversation, its sender and its words
+	The senders are interned over all the conversations.  A time window is found with two binary searches, without going through the conversations
+	"""
+	COLUMNS = ['timestamps', 'conversation_ids', 'sender_ids', 'word_counts']
+
+	def __init__(self, timestamps, conversation_ids, sender_ids, word_counts, senders, num_conversations):
+		self.timestamps = timestamps
+		self.conversation_ids = conversation_ids
+		self.sender_ids = sender_ids
+		self.word_counts = word_counts
+		self.senders = senders
+		self.num_conversations = num_conversations
+
+	def __len__(self):
+		return len(self.timestamps)
+
+	@classmethod
+	def build(cls, conversations):
+		global_ids = {}
+		columns = {column: [np.empty(0, dtype=dtype)] for (column, dtype) in zip(cls.COLUMNS, [np.int64, np.uint32, np.uint32, np.int64])}
+		for (conversation_id, conversation) in enumerate(conversations):
+			store = conversation.store
+			id_map = np.array([global_ids.setdefault(name, len(global_ids)) for name in store.senders], dtype=np.uint32)
+			columns['timestamps'].append(np.frombuffer(store.timestamps, dtype=np.int64))
+			columns['conversation_ids'].append(np.full(len(store), conversation_id, dtype=np.uint32))
+			columns['sender_ids'].append(id_map[np.frombuffer(store.sender_ids, dtype=np.uint32)])
+			columns['word_counts'].append(np.frombuffer(store.word_counts, dtype=np.int64))
+
+		timestamps = np.concatenate(columns['timestamps'])
+		order = np.argsort(timestamps, kind='stable')
+		return cls(*[np.concatenate(columns[column])[order] for column in cls.COLUMNS], senders=list(global_ids), num_conversations=len(conversations))
+
+	def window(self, since=None, until=None):
+		"""The (start, stop) rows of the messages from `since` up to, but not including, `until`.  Either can be None for no limit"""
+		start = 0 if since is None else int(np.searchsorted(self.timestamps, since, side='left'))
+		stop = len(self) if until is None else int(np.searchsorted(self.timestamps, until, side='left'))
+		return (start, max(start, stop))
+
+	def conversation_counts(self, since=None, until=None):
+		"""The number of messages of each conversation in the window"""
+		(start, stop) = self.window(since, until)
+		return np.bincount(self.conversation_ids[start:stop], minlength=self.num_conversations)
+
+	def sender_count(self, name, since=None, until=None):
+		"""The number of messages the sender sent in the window, over all conversations"""
+		if name not in self.senders:
+			return 0
+		(start, stop) = self.window(since, until)
+		return int(np.count_nonzero(self.sender_ids[start:stop] == self.senders.index(name)))
+
+	def save(self, file_path, key):
+		with atomic_path(file_path) as tmp_path, open(tmp_path, 'wb') as f:
+			np.savez(f, key=np.array(key), senders=np.array(self.senders, dtype=str), num_conversations=np.array(self.num_conversations),
+				**{column: getattr(self, column) for column in self.COLUMNS})
+
+	@classmethod
+	def load(cls, file_path, key):
+		"""Returns the saved index, or None if there is none or it was built with another key"""
+		try:
+			with np.load(file_path) as data:
+				if str(data['key']) != key:
+					return None
+				return cls(*[data[column] for column in cls.COLUMNS], senders=data['senders'].tolist(), num_conversations=int(data['num_conversations']))
+		except (OSError, ValueError, KeyError):
+			return None
+
+def timeline_index(conversations):
+	"""
+	The TimelineIndex of the conversations.  It is loaded from `cache_dir` if it was built from the same conversations with the same settings,
+	otherwise it is built and saved there
+	"""
+	key = _conversations_key(conversations)
+	file_path = os.path.join(cache_dir, TIMELINE_FILE)
+	if use_cache and not rebuild_cache:
+		index = TimelineIndex.load(file_path, key)
+		if index is not None:
+			return index
+
+	index = TimelineIndex.build(conversations)
+	if use_cache:
+		index.save(file_path, key)
+	return index
+
+def _conversations_key(conversations):
+	"""Key of the indexes built over all the conversations.  They are told apart by their files and totals, which change whenever their messages do"""
+	return hashlib.sha1(json.dumps([_cache_settings(), [[conversation.store.sources, len(conversation.store), conversation.store.totals]
+		for conversation in conversations]]).encode('utf-8')).hexdigest()
+
+def window_conversations(conversations, timeline, since=None, until=None):
+	"""The conversations with messages in the window, each cut down to them.  `timeline` is the TimelineIndex of all the conversations"""
+	counts = timeline.conversation_counts(since, until)
+	return [conversation.window(since, until) for (conversation, count) in zip(conversations, counts.tolist()) if count]
+
+def parse_time_bound(text, is_until=False):
+	"""
+	The timestamp_ms of a `--since` or `--until` date in local time: 'YYYY-MM-DD', 'YYYY-MM', 'YYYY-Qn', 'YYYY', or 'Nd' for N days ago
+	For `--until` a date ends with its day, month, quarter or year, so both bounds include the dates given
+	"""
+	match = re.match(r'^(\d+)d$', text)
+	if match:
+		return int(time.time() * 1000) - int(match.group(1)) * DAY_MS
+
+	match = re.match(r'^(\d{4})-Q([1-4])$', text)
+	if match:
+		(start, months) = (datetime(int(match.group(1)), (int(match.group(2)) - 1) * 3 + 1, 1), 3)
+	else:
+		for (date_format, months) in [('%Y-%m-%d', 0), ('%Y-%m', 1), ('%Y', 12)]:
+			try:
+				start = datetime.strptime(text, date_format)
+				break
+			except ValueError:
+				continue
+		else:
+			raise ValueError('Unknown date {!r}. Use YYYY-MM-DD, YYYY-MM, YYYY-Qn, YYYY or Nd'.format(text))
 
-	def words_in_message(self, include_call=False):
-		call_words = 0
-		if include_call and self.is_call:
-			call_words = call_speak_rate * self.call_duration
-		
-		return call_words if self.is_call() else len(self.content.split())
+	if is_until:
+		if months:
+			month = start.month - 1 + months
+			start = start.replace(year=start.year + month // 12, month=month % 12 + 1)
+		else:
+			start += timedelta(days=1)
+	return int(start.timestamp() * 1000)
 
-	def imgur_links_in_message(self):
-		return 1 if ('imgur' in getattr(self, 'share', {'link':''}).get('link', '')) or ('imgur.com' in self.content) else 0
 
 
-	def __str__(self):
-		msg =  """
-		Conversation: {conv}
-		Sender: {sender}
-		Type: {type}
-		Time: {time}
-		""".format(conv=self.conversation.other_person, sender=self.sender, type=self.type, time=self.time).strip()
-
-		if self.is_call():
-			msg += 'Call Duration: {dur}'.format(dur=self.call_duration)
-		else:
-			msg += 'Content: {content}'.format(content=self.content)
+###########################################################################
+# Utils
 
-		return msg
+def period_bins(timestamps, period=MONTH_GRANULARITY):
+	"""
+	Bins int64 timestamp_ms into periods of local time, the same way `datetime.fromtimestamp` would
+	Returns (keys, codes): the sorted keys of the periods that have messages, and for every timestamp the index of its key
+	"""
+	local_ms = timestamps + _local_utc_offsets_ms(timestamps)
+	if period == WEEK_GRANULARITY:
+		# Weeks start on monday. 1970-01-01 was a thursday
+		days = local_ms // DAY_MS
+		periods, codes = np.unique(days - (days + 3) % 7, return_inverse=True)
+		return np.datetime_as_string(periods.astype('datetime64[D]')).tolist(), codes
+	if period == QUARTER_GRANULARITY:
+		# Keyed by their first month, so they still read as dates
+		months = local_ms.astype('datetime64[ms]').astype('datetime64[M]').astype(np.int64)
+		periods, codes = np.unique(months - months % 3, return_inverse=True)
+		return np.datetime_as_string(periods.astype('datetime64[M]')).tolist(), codes
+
+	unit = {DAY_GRANULARITY: 'D', MONTH_GRANULARITY: 'M', YEAR_GRANULARITY: 'Y'}[period]
+	periods, codes = np.unique(local_ms.astype('datetime64[ms]').astype('datetime64[{}]'.format(unit)), return_inverse=True)
+	return np.datetime_as_string(periods, unit=unit).tolist(), codes
+
+def _local_utc_offsets_ms(timestamps):
+	"""
+	The local timezone's utc offset at every timestamp
+	Offsets are looked up at the start and end of each distinct day. On the few days where they differ, the moment of the change is searched for
+	"""
+	days, codes = np.unique(timestamps // DAY_MS, return_inverse=True)
+	codes = codes.reshape(-1)
+	day_starts = [day * DAY_MS for day in days.tolist()]
+	start_offsets = np.array([_local_utc_offset_ms(start) for start in day_starts], dtype=np.int64)
+	end_offsets = np.array([_local_utc_offset_ms(start + DAY_MS - 1) for start in day_starts], dtype=np.int64)
+
+	# The first moment of each day that has the end-of-day offset
+	changes = np.array([start + DAY_MS for start in day_starts], dtype=np.int64)
+	for idx in np.flatnonzero(start_offsets != end_offsets).tolist():
+		low, high = day_starts[idx], day_starts[idx] + DAY_MS - 1
+		while low < high:
+			middle = (low + high) // 2
+			if _local_utc_offset_ms(middle) == end_offsets[idx]:
+				high = middle
+			else:
+				low = middle + 1
+		changes[idx] = low
 
+	return np.where(timestamps < changes[codes], start_offsets[codes], end_offsets[codes])
 
+def _local_utc_offset_ms(timestamp_ms):
+	seconds = timestamp_ms / 1000
+	offset = datetime.fromtimestamp(seconds) - datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+	return int(offset.total_seconds() * 1000)
 
-###########################################################################
-# Utils
+def count_words(content):
+	return len(content.split())
 
-def is_worth_including(message_list):
-	return len(message_list) >= is_worth_including_threshold
+@lru_cache(maxsize=None)
+def link_matchers(domains):
+	"""
+	Returns (match_share, search_content).  `match_share` is whether a shared link's host is one of the domains or a subdomain of one,
+	and `search_content` whether the content has any of the whole domains in it.  Without domains, neither matches anything
+	"""
+	if not domains:
+		return (lambda link: False, lambda content: None)
+	domains = tuple(domain.lower() for domain in domains)
+	subdomain_suffixes = tuple('.' + domain for domain in domains)
+	def match_share(link):
+		host = link_host(link)
+		return host in domains or host.endswith(subdomain_suffixes)
+	return (match_share, re.compile('|'.join(map(re.escape, domains))).search)
+
+def link_host(link):
+	"""The lowercased host of a link, which may leave out the scheme.  Empty if it has none"""
+	try:
+		return urlsplit(link if '//' in link else '//' + link).hostname or ''
+	except ValueError:
+		return ''
+
+def is_worth_including(num_messages):
+	return num_messages >= is_worth_including_threshold
 
 def print_header(header_str):
 	print('{bold}{red}========  {header}  ========{end}'.format(bold=BOLD, red=RED, header=header_str, end=END))
@@ -414,128 +1105,431 @@ def print_messaging_history_words_per_month(conversations, up_to=7, sort_mode=TO
 def print_conversation_starts(conversations, up_to=7, sort_mode=TOTAL_MESSAGES_SORT_MODE, hour_threshold=72):
 	_print_messages(conversations, up_to, sort_mode, lambda conversation: conversation.number_conversation_starts(hour_threshold=hour_threshold))
 
+def print_conversation_starts_sweep(conversations, hour_thresholds, up_to=7, sort_mode=TOTAL_MESSAGES_SORT_MODE):
+	"""
+	Prints how many conversations each side started after every one of the hour thresholds, for the top conversations and for all of them together
+	"""
+	columns = ''.join('{:>9}'.format('{:g}h'.format(hour_threshold)) for hour_threshold in hour_thresholds)
+	def rows(counts, other_name):
+		return '\n'.join('    {:<24}{}'.format(label, ''.join('{:>9}'.format(count) for count in counts[group])) for (label, group) in [
+			(my_facebook_name, 'me'), (other_name, 'other'), (my_facebook_name + ' Links', 'me_links'), (other_name + ' Links', 'other_links')])
+
+	def conversation_rows(conversation):
+		return '{}\n    {:<24}{}\n{}'.format(conversation.header_str, 'Hours Apart', columns, rows(conversation.starts_index().count_starts(hour_thresholds), conversation.other_person))
+	_print_messages(conversations, up_to, sort_mode, conversation_rows)
+
+	totals = {group: [0] * len(hour_thresholds) for group in ConversationStartsIndex.GROUPS}
+	for conversation in conversations:
+		for (group, counts) in conversation.starts_index().count_starts(hour_thresholds).items():
+			totals[group] = [total + count for (total, count) in zip(totals[group], counts)]
+	print_header('Conversation Starts Over All {} Conversations'.format(len(conversations)))
+	print('    {:<24}{}\n{}'.format('Hours Apart', columns, rows(totals, 'Others')))
+
+def print_participants(conversations, up_to=7, sort_mode=TOTAL_MESSAGES_SORT_MODE, participants_shown=10):
+	"""
+	Prints the messages, words, links and calls of the `participants_shown` senders with the most messages, for each of the top conversations
+	"""
+	def conversation_rows(conversation):
+		participants = conversation.participants()
+		shown = participants.by_messages()[:participants_shown]
+		rows = ['    {:<32}{:>10}{:>12}{:>8}{:>8}'.format('Participant', 'Messages', 'Words', 'Links', 'Calls')]
+		for sender_id in shown:
+			rows.append('    {:<32}{:>10}{:>12}{:>8}{:>8}'.format(participants.names[sender_id][:31], participants.num_messages[sender_id],
+				participants.words(sender_id), participants.num_links[sender_id], participants.num_calls[sender_id]))
+		if len(participants) > len(shown):
+			rows.append('    and {} more'.format(len(participants) - len(shown)))
+		return '{}\n{}'.format(conversation.header_str, '\n'.join(rows))
+	_print_messages(conversations, up_to, sort_mode, conversation_rows)
+
+def print_vocabulary(conversations, up_to=7, sort_mode=TOTAL_MESSAGES_SORT_MODE, words_shown=10):
+	"""
+	Prints the tokens, distinct words and `words_shown` most used words of each side of the top conversations, and of all of them together,
+	from the sketches of `vocabulary_sketches`.  The sketches count tokens, not the whitespace separated words of the summary
+	"""
+	def rows(vocabulary, other_name):
+		(mine, theirs) = (vocabulary['me'], vocabulary['other'])
+		lines = ['    {:<16}{:>28}{:>28}'.format('', my_facebook_name[:27], other_name[:27]),
+			'    {:<16}{:>28}{:>28}'.format('Tokens', mine.num_words(), theirs.num_words()),
+			'    {:<16}{:>28}{:>28}'.format('Distinct Words', '~{}'.format(mine.distinct.estimate()), '~{}'.format(theirs.distinct.estimate()))]
+		for (rank, (my_word, their_word)) in enumerate(itertools.zip_longest(mine.top(words_shown), theirs.top(words_shown))):
+			lines.append('    {:<16}{:>28}{:>28}'.format(rank+1, _word_count_str(my_word), _word_count_str(their_word)))
+		return '\n'.join(lines)
+
+	_print_messages(conversations, up_to, sort_mode, lambda conversation: '{}\n{}'.format(conversation.header_str,
+		rows(conversation.store.vocabulary, 'Others' if conversation.summary.is_group else conversation.other_person)))
+
+	# The sketches of every conversation merge into one of all of them
+	total = {'me': WordSketch(), 'other': WordSketch()}
+	for conversation in conversations:
+		for (side, sketch) in conversation.store.vocabulary.items():
+			total[side].merge(sketch)
+	print_header('Vocabulary Over All {} Conversations'.format(len(conversations)))
+	print(rows(total, 'Others'))
+	print_header('Vocabulary Error Bounds')
+	print('    Distinct words are estimates with a standard error of {:.1%}'.format(total['me'].distinct.relative_error()))
+	print('    Counts shown as low-high hold the true count, other counts are exact')
+	print('    Tokens are lowercased runs of letters and digits, so they differ from the whitespace separated words of the summary')
+
+def _word_count_str(word_count):
+	if word_count is None:
+		return ''
+	(word, low, high) = word_count
+	return '{} {}'.format(word[:16], high) if low == high else '{} {}-{}'.format(word[:16], low, high)
+
 def sort_conversations(conversations, sort_mode):
 	sort_obj = SORT_CONFIGS[sort_mode]
 	return sorted(conversations, key=sort_obj['sort_func'], reverse=sort_obj['reverse'])
 
+def top_conversations(conversations, sort_mode, up_to):
+	"""
+	The first `up_to` conversations of `sort_conversations`, picked with a heap instead of sorting all of them
+	heapq keeps ties in their original order, so the result is the same as slicing the sorted list
+	"""
+	sort_obj = SORT_CONFIGS[sort_mode]
+	select = heapq.nlargest if sort_obj['reverse'] else heapq.nsmallest
+	return select(up_to, conversations, key=sort_obj['sort_func'])
+
 
 def _print_messages(conversations, up_to, sort_mode, print_func):
 	print_header('Top ' + str(up_to) + ' Conversations Sorted By ' + SORT_CONFIGS[sort_mode]['type'])
-	sorted_conversations = sort_conversations(conversations, sort_mode)
-	for idx, conversation in enumerate(sorted_conversations[0:up_to]):
+	for idx, conversation in enumerate(top_conversations(conversations, sort_mode, up_to)):
 		print(idx+1, print_func(conversation))
 
 def display_conversations_as_bars(conversations, up_to=5, sort_mode=TOTAL_MESSAGES_SORT_MODE, use_words=False, bar_mode='group', calls_graphs=False):
-	conversations_sorted = sort_conversations(conversations, sort_mode)
-
-	history_total_msgs_figure = go.Figure(
-		data=[conv.messages_history_bar_obj() for conv in conversations_sorted[0:up_to]]
-	)
-	_style_bar_chart(history_total_msgs_figure, 'Total Messages Sent In Conversation Over Time', y_axis_title='Total Number of Messages Sent', bar_mode=bar_mode)
-	history_total_msgs_figure.show()
+	for (_, figure) in conversations_bar_figures(conversations, up_to=up_to, sort_mode=sort_mode, use_words=use_words, bar_mode=bar_mode, calls_graphs=calls_graphs):
+		figure.show()
+
+def conversations_bar_figures(conversations, up_to=5, sort_mode=TOTAL_MESSAGES_SORT_MODE, use_words=False, bar_mode='group', calls_graphs=False):
+	"""Returns (name, figure) for each history bar graph, in the order they are displayed.  The name is used as the file name when rendering"""
+	import graphs
+	conversations_sorted = top_conversations(conversations, sort_mode, up_to)
+	period = graph_period(conversations_sorted)
+	suffix = _graph_title_suffix(period)
+	figures = []
+
+	history_total_msgs_figure = graphs.bar_figure([conv.messages_history_bar_obj(period) for conv in conversations_sorted],
+		'Total Messages Sent In Conversation Over Time' + suffix, y_axis_title='Total Number of Messages Sent', bar_mode=bar_mode)
+	figures.append(('total-messages', history_total_msgs_figure))
 	
 	if calls_graphs:
-		history_calls_figure = go.Figure(
-			data=[conv.call_history_bar_obj() for conv in conversations_sorted[0:up_to]]
-		)
-		_style_bar_chart(history_calls_figure, 'Total Calls In Conversation Over Time', y_axis_title='Number of Calls', bar_mode=bar_mode)
-		history_calls_figure.show()
+		history_calls_figure = graphs.bar_figure([conv.call_history_bar_obj(period) for conv in conversations_sorted],
+			'Total Calls In Conversation Over Time' + suffix, y_axis_title='Number of Calls', bar_mode=bar_mode)
+		figures.append(('calls', history_calls_figure))
 
 	if use_words:
-		history_words_figure = go.Figure(
-			data=[conv.words_history_bar_obj() for conv in conversations_sorted[0:up_to]]
-		)
-		_style_bar_chart(history_words_figure, 'Total Words Written In Conversation Over Time', y_axis_title='Total Amount of Words Written', bar_mode=bar_mode)
-		history_words_figure.show()
+		history_words_figure = graphs.bar_figure([conv.words_history_bar_obj(period) for conv in conversations_sorted],
+			'Total Words Written In Conversation Over Time' + suffix, y_axis_title='Total Amount of Words Written', bar_mode=bar_mode)
+		figures.append(('words', history_words_figure))
 
 		if calls_graphs:
-			history_calls_duration_figure = go.Figure(
-				data=[conv.call_duration_history_bar_obj() for conv in conversations_sorted[0:up_to]]
-			)
-			_style_bar_chart(history_calls_duration_figure, 'Total Seconds Spent on Call in Conversation Over Time', y_axis_title='Seconds Spent On Call', bar_mode=bar_mode)
-			history_calls_duration_figure.show()
-
-
-def _style_bar_chart(figure, name, y_axis_title, bar_mode='group'):
-	figure.update_layout(
-		barmode=bar_mode,
-		title=go.layout.Title(
-			text=name,
-			xref='paper',
-			x=0
-		),
-		xaxis=go.layout.XAxis(
-			nticks=50,
-			tickangle=-45
-		),
-		yaxis=go.layout.YAxis(
-		title=go.layout.yaxis.Title(text=y_axis_title)
-		)
-	)
+			history_calls_duration_figure = graphs.bar_figure([conv.call_duration_history_bar_obj(period) for conv in conversations_sorted],
+				'Total Seconds Spent on Call in Conversation Over Time' + suffix, y_axis_title='Seconds Spent On Call', bar_mode=bar_mode)
+			figures.append(('call-duration', history_calls_duration_figure))
+
+	return figures
+
+
+def graph_period(conversations):
+	"""
+	The period the conversations are graphed in: the granularity, or the shortest longer one that keeps every trace within max_points_per_trace
+	Totals over longer periods are exact, as each history is binned again from the message timestamps
+	"""
+	if not max_points_per_trace:
+		return granularity
+	periods = GRANULARITIES[GRANULARITIES.index(granularity):]
+	for period in periods:
+		if all(len(conversation.history_per(period).message_dates) <= max_points_per_trace for conversation in conversations):
+			return period
+	return periods[-1]
+
+def _graph_title_suffix(period):
+	return '' if period == granularity else ' Per {}'.format(period.capitalize())
 
 def display_conversations_relative_percents(conversations, up_to=5, sort_mode=TOTAL_MESSAGES_SORT_MODE, use_words=False):
 	"""
 	Honestly, these graphs are kinda ugly.  Thought they'd be cool, but with more than 3 people, they're just messy
 	"""
-	conversations_sorted = sort_conversations(conversations, sort_mode)
+	for (_, figure) in conversations_relative_percent_figures(conversations, up_to=up_to, sort_mode=sort_mode, use_words=use_words):
+		figure.show()
 
-	total_messages_figure = go.Figure()
-	for conv in conversations_sorted[0:up_to]:
-		total_messages_figure.add_trace(conv.messages_history_relative_line_obj())
+def conversations_relative_percent_figures(conversations, up_to=5, sort_mode=TOTAL_MESSAGES_SORT_MODE, use_words=False):
+	"""Returns (name, figure) for each relative percent graph, like `conversations_bar_figures`"""
+	import graphs
+	conversations_sorted = top_conversations(conversations, sort_mode, up_to)
+	period = graph_period(conversations_sorted)
+	suffix = _graph_title_suffix(period)
+	figures = []
 
-	_style_relative_percent_chart(total_messages_figure, 'Relative Percents of Total Messages Over Time')
-	total_messages_figure.show()
+	total_messages_figure = graphs.relative_percent_figure([conv.messages_history_relative_line_obj(period) for conv in conversations_sorted],
+		'Relative Percents of Total Messages Over Time' + suffix)
+	figures.append(('relative-messages', total_messages_figure))
 
 	if use_words:
-		total_words_figure = go.Figure()
-		for conv in conversations_sorted[0:up_to]:
-			total_words_figure.add_trace(conv.words_history_relative_line_obj())
-
-		_style_relative_percent_chart(total_words_figure, 'Relative Percents of Words Sent Over Time')
-		total_words_figure.show()
-
-def _style_relative_percent_chart(figure, name):
-	figure.update_layout(
-		showlegend=True,
-		title=go.layout.Title(
-			text=name,
-			xref='paper',
-			x=0
-		),
-		yaxis=dict(
-			type='linear',
-			range=[1, 100],
-			ticksuffix='%'
-		)
-	)
-
-def get_conversations():
+		total_words_figure = graphs.relative_percent_figure([conv.words_history_relative_line_obj(period) for conv in conversations_sorted],
+			'Relative Percents of Words Sent Over Time' + suffix)
+		figures.append(('relative-words', total_words_figure))
+
+	return figures
+
+def render_figures(figures, render_dir, render_format=HTML_RENDER_FORMAT, workers=1):
+	"""
+	Writes each (name, figure) to `{render_dir}/{name}.{render_format}` instead of showing it, spread over `workers` processes
+	The html files load the plotly.js bundle from the PLOTLY_JS_FILE next to them, so it is only written once
+	Returns the paths of the written files
+	"""
+	import graphs
+	os.makedirs(render_dir, exist_ok=True)
+	if render_format == HTML_RENDER_FORMAT:
+		with open(os.path.join(render_dir, PLOTLY_JS_FILE), 'w', encoding='utf-8') as f:
+			f.write(graphs.plotly_js())
+
+	# The workers get plain dicts, which pickle much faster than figures
+	jobs = [(os.path.join(render_dir, '{}.{}'.format(name, render_format)), figure.to_dict(), render_format) for (name, figure) in figures]
+	if workers > 1 and len(jobs) > 1:
+		with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as executor:
+			return list(executor.map(_render_figure, jobs))
+	return list(map(_render_figure, jobs))
+
+def _render_figure(job):
+	import graphs
+	(file_path, figure, render_format) = job
+	if render_format == HTML_RENDER_FORMAT:
+		text = graphs.figure_html(figure)
+	else:
+		text = graphs.figure_json(figure)
+	with open(file_path, 'w', encoding='utf-8') as f:
+		f.write(text)
+	return file_path
+
+# What `load_conversation_folder` found out about a folder
+# conversation is None if it is not worth including. The skipped files are those whose messages were never parsed
+# new_messages is how many messages were added to the conversation in `--incremental` mode
+# read_bytes and read_messages are the size of the files whose messages were parsed, and how many messages that was
+FolderResult = namedtuple('FolderResult', ['has_json_files', 'is_two_people', 'conversation', 'from_cache', 'skipped_files', 'skipped_bytes', 'new_messages',
+	'read_bytes', 'read_messages'], defaults=[0, 0, 0])
+
+def load_conversation_folder(name):
+	"""
+	Parses every json file of a single conversation folder and builds its Conversation, or loads it from the cache if none of the files changed
+	Returns a FolderResult
+	Is module-level so it can be run in a worker process
+	"""
+	files = os.listdir(path + '/' + name)
+	json_files = [file_name for file_name in files if '.json' in file_name]
+	if not json_files:
+		return FolderResult(False, False, None, False, 0, 0)
+
+	json_files.sort()
+	if incremental:
+		return _load_conversation_folder_incrementally(name, json_files)
+
+	file_stats = None
+	if use_cache:
+		file_stats = _file_stats(name, json_files)
+		entry = None if rebuild_cache else read_cache_entry(name, file_stats)
+		# An entry saved without the conversation can't be used if the include threshold got lowered since
+		if entry and (entry['conversation'] or not is_worth_including(entry['num_messages'])):
+			conversation = None
+			if entry['conversation'] and is_worth_including(entry['num_messages']):
+				conversation = Conversation.from_cache_dict(entry['conversation'])
+			return FolderResult(True, entry['is_two_people'], conversation, True, 0, 0)
+
+	# Large conversations get split up in multiple files, so we have to consolidate the conversation
+	# Note that current facebook implementation has `message_1.json` the newest files, and `message_3.json` the oldest, so we can just stream them in one after another
+	readers = [MessageFileReader(_json_file_path(name, file_name), whole_file_size=whole_file_size) for file_name in json_files]
+	try:
+		# Prefilter: only the participants before the messages have been read so far, so skipped files never get their messages parsed
+		is_two_people = len(readers[0].header['participants']) == 2
+		included = [reader for reader in readers if is_included(reader.header)]
+		max_messages = max_num_messages([reader.file_path for reader in included])
+		if not is_worth_including(max_messages):
+			included = []
+
+		store = MessageStore()
+		store.group_title = group_title(readers[0].header)
+		for reader in included:
+			store.add_messages(reader, reader.file_path)
+	finally:
+		for reader in readers:
+			reader.close()
+
+	skipped_paths = [reader.file_path for reader in readers if reader not in included]
+	skipped_bytes = sum(os.path.getsize(file_path) for file_path in skipped_paths)
+
+	# For prefiltered conversations the cache gets the upper bound, which still tells if they are worth including
+	num_messages = len(store) if included else max_messages
+	conversation = Conversation(store) if is_worth_including(num_messages) else None
+	if use_cache:
+		write_cache_entry(name, file_stats, is_two_people, num_messages, conversation)
+	read_bytes = sum(os.path.getsize(reader.file_path) for reader in included)
+	return FolderResult(True, is_two_people, conversation, False, len(skipped_paths), skipped_bytes, read_bytes=read_bytes, read_messages=len(store))
+
+def _load_conversation_folder_incrementally(name, json_files):
+	"""
+	Like `load_conversation_folder`, but keeps the conversation in `cache_dir` by folder name, along with the newest timestamp_ms seen
+	Only the messages newer than that get read and merged in. They come first, so reading stops at the first message that isn't newer
+	Every included conversation is kept regardless of the include threshold, as it might pass the threshold in a later export
+	"""
+	entry = None if rebuild_cache else read_incremental_entry(name)
+	conversation = None
+	watermark = None
+	forgot_sources = False
+	if entry and entry['conversation']:
+		conversation = Conversation.from_cache_dict(entry['conversation'])
+		watermark = entry['newest_timestamp_ms']
+		# The older messages came from the json files of earlier exports, which may have been moved or deleted since
+		# Those that are gone lose their path, so nothing tries to read them again, and the search leaves their messages out with a warning
+		for source in conversation.store.sources:
+			if source[0] is not None and not os.path.isfile(source[0]):
+				source[0] = None
+				forgot_sources = True
+
+	# Always streamed one message at a time, as reading usually stops after the first few messages
+	readers = [MessageFileReader(_json_file_path(name, file_name)) for file_name in json_files]
+	try:
+		is_two_people = len(readers[0].header['participants']) == 2
+		included = [reader for reader in readers if is_included(reader.header)]
+
+		newer_store = MessageStore()
+		newer_store.group_title = group_title(readers[0].header)
+		read_bytes = 0
+		for reader in included:
+			read_bytes += os.path.getsize(reader.file_path)
+			reached_watermark = []
+			newer_store.add_messages(_messages_newer_than(reader, watermark, reached_watermark), reader.file_path)
+			if reached_watermark:
+				break
+	finally:
+		for reader in readers:
+			reader.close()
+
+	new_messages = len(newer_store)
+	if new_messages:
+		if conversation:
+			conversation.add_newer_messages(newer_store)
+		else:
+			conversation = Conversation(newer_store)
+	if new_messages or forgot_sources or not entry:
+		write_incremental_entry(name, is_two_people, conversation)
+
+	skipped_paths = [reader.file_path for reader in readers if reader not in included]
+	skipped_bytes = sum(os.path.getsize(file_path) for file_path in skipped_paths)
+	if conversation and not is_worth_including(conversation.summary.total_messages):
+		conversation = None
+	return FolderResult(True, is_two_people, conversation, new_messages == 0 and entry is not None, len(skipped_paths), skipped_bytes, new_messages,
+		read_bytes, new_messages)
+
+def _json_file_path(name, file_name):
+	# Absolute, as the stores keep it in their sources to read the messages again, also from a cache used from another directory
+	return os.path.abspath('{}/{}/{}'.format(path, name, file_name))
+
+def is_included(header):
+	"""Whether the messages of a json file get analyzed, going by the participants in its header"""
+	return len(header['participants']) == 2 or (include_groups and len(header['participants']) > 2)
+
+def group_title(header):
+	"""The title of a group conversation's json file, or the other participants' names if it has none.  Empty for two people"""
+	if len(header['participants']) <= 2:
+		return ''
+	return header.get('title') or ', '.join(participant['name'] for participant in header['participants'] if participant['name'] != my_facebook_name)
+
+def _messages_newer_than(messages, watermark, reached_watermark):
+	"""Yields messages until one is not newer than the watermark, which gets noted in the `reached_watermark` list"""
+	for message in messages:
+		if watermark is not None and message['timestamp_ms'] <= watermark:
+			reached_watermark.append(message['timestamp_ms'])
+			return
+		yield message
+
+def max_num_messages(file_paths):
+	"""
+	An upper bound of the number of messages in the files, found without parsing them
+	The file sizes give a first bound. Small conversations that might be below the include threshold get their message keys counted
+	"""
+	num_bytes = sum(os.path.getsize(file_path) for file_path in file_paths)
+	if num_bytes // MIN_MESSAGE_BYTES < is_worth_including_threshold or num_bytes > is_worth_including_threshold * PREFILTER_COUNT_BYTES_PER_MESSAGE:
+		return num_bytes // MIN_MESSAGE_BYTES
+	return sum(_count_in_file(file_path, MESSAGE_COUNT_KEY) for file_path in file_paths)
+
+def _count_in_file(file_path, pattern):
+	count = 0
+	tail = b''
+	with open(file_path, 'rb') as f:
+		while True:
+			chunk = f.read(CHUNK_SIZE)
+			if not chunk:
+				return count
+			data = tail + chunk
+			count += data.count(pattern)
+			# Too short to hold the whole pattern, so nothing gets counted twice
+			tail = data[-(len(pattern) - 1):]
+
+def _timed_load_conversation_folder(name):
+	"""`load_conversation_folder` along with (start, wall seconds, cpu seconds, pid) of the process that loaded it, for the profile"""
+	start = time.perf_counter()
+	start_cpu = time.process_time()
+	result = load_conversation_folder(name)
+	return (result, (start, time.perf_counter() - start, time.process_time() - start_cpu, os.getpid()))
+
+def _worker_settings():
+	"""The module-level parameters a worker process needs to build conversations exactly like the main process"""
+	return {
+		'my_facebook_name': my_facebook_name,
+		'path': path,
+		'is_worth_including_threshold': is_worth_including_threshold,
+		'include_call_words': include_call_words,
+		'call_speak_rate': call_speak_rate,
+		'min_call_duration_length': min_call_duration_length,
+		'link_domains': link_domains,
+		'granularity': granularity,
+		'cache_dir': cache_dir,
+		'use_cache': use_cache,
+		'rebuild_cache': rebuild_cache,
+		'incremental': incremental,
+		'include_groups': include_groups,
+		'vocabulary_sketches': vocabulary_sketches,
+		'whole_file_size': whole_file_size,
+	}
+
+def _init_worker(settings):
+	# Worker processes started with 'spawn' re-import this file, so the parameters set in `__main__` have to be passed along
+	globals().update(settings)
+
+def get_conversations(workers=1, profiler=None):
 	conversations = []
 	num_conversations = 0
 	num_conversations_with_two_people = 0
+	num_from_cache = 0
+	skipped_files = 0
+	skipped_bytes = 0
+	num_updated = 0
+	new_messages = 0
 
 	folders = os.listdir(path)
-	for name in folders:
-		files = os.listdir(path + '/' + name)
-		has_json_files = any('.json' in file_name for file_name in files)
-		if has_json_files:
+	if workers > 1:
+		# `map` yields results in the order of `folders`, so the output is the same as the serial run
+		with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(_worker_settings(),)) as executor:
+			results = list(executor.map(_timed_load_conversation_folder, folders, chunksize=max(1, len(folders) // (workers * 4))))
+	else:
+		results = map(_timed_load_conversation_folder, folders)
+
+	for (name, (result, timing)) in zip(folders, results):
+		if profiler is not None and result.has_json_files:
+			(start, wall, cpu, pid) = timing
+			profiler.add_conversation(name, start, wall, cpu, result.read_bytes, result.read_messages, result.from_cache, pid)
+		if result.has_json_files:
 			num_conversations += 1
-			json_files = [file_name for file_name in files if '.json' in file_name]
-			json_files.sort()
-			# Large conversations get split up in multiple files, so we have to consolidate the conversation
-			# Note that current facebook implementation has `message_1.json` the newest files, and `message_3.json` the oldest, so we can just concat them together
-			all_messages = []
-			for idx, file_name in enumerate(json_files):
-				with open('{}/{}/{}'.format(path, name, file_name)) as f:
-					data = json.load(f)
-					participants = data['participants']
-					if len(participants) == 2:
-						if idx == 0:
-							num_conversations_with_two_people += 1
-						all_messages.extend(data['messages'])
-					
-			if is_worth_including(all_messages):
-				conversations.append(Conversation(all_messages))
+		if result.from_cache:
+			num_from_cache += 1
+		if result.is_two_people:
+			num_conversations_with_two_people += 1
+		if result.conversation is not None:
+			conversations.append(result.conversation)
+		skipped_files += result.skipped_files
+		skipped_bytes += result.skipped_bytes
+		if result.new_messages:
+			num_updated += 1
+			new_messages += result.new_messages
 
 	print_header('Number of Conversations Found')
 	print(num_conversations)
@@ -543,9 +1537,439 @@ def get_conversations():
 	print(num_conversations_with_two_people)
 	print_header('Messages Worth Including')
 	print(len(conversations))
+	if include_groups:
+		print_header('Group Conversations Worth Including')
+		print(sum(1 for conversation in conversations if conversation.summary.is_group))
+	if incremental:
+		print_header('Conversations With New Messages')
+		print('{} ({} new messages)'.format(num_updated, new_messages))
+	elif use_cache:
+		print_header('Conversations Loaded From Cache')
+		print(num_from_cache)
+	print_header('Files Skipped Without Parsing Messages')
+	print('{} ({:.1f} MB)'.format(skipped_files, skipped_bytes / 1e6))
 
 	return conversations
 
+###########################################################################
+# Analysis cache
+# Each conversation folder gets one json file in `cache_dir` holding its computed summary and history
+# An entry is only used if every json file in the folder has the same mtime and size as when it was written,
+# and the parameters that change the computed numbers are the same
+
+def _cache_settings():
+	return {
+		'version': CACHE_VERSION,
+		'my_facebook_name': my_facebook_name,
+		'include_call_words': include_call_words,
+		'call_speak_rate': call_speak_rate,
+		'min_call_duration_length': min_call_duration_length,
+		'link_domains': link_domains,
+		'include_groups': include_groups,
+		'vocabulary_sketches': vocabulary_sketches,
+	}
+
+def _file_stats(name, json_files):
+	stats = {}
+	for file_name in json_files:
+		stat = os.stat('{}/{}/{}'.format(path, name, file_name))
+		stats[file_name] = [stat.st_mtime_ns, stat.st_size]
+	return stats
+
+def _cache_entry_path(name):
+	folder = os.path.abspath('{}/{}'.format(path, name))
+	# The hash keeps conversations with the same folder name in different inboxes apart
+	return '{}/{}-{}.json'.format(cache_dir, name, hashlib.sha1(folder.encode('utf-8')).hexdigest()[:12])
+
+def read_cache_entry(name, file_stats):
+	"""Returns the cache entry of the folder, or None if there is none or it is out of date"""
+	try:
+		with open(_cache_entry_path(name)) as f:
+			entry = json.load(f)
+	except (OSError, ValueError):
+		return None
+
+	if entry.get('settings') != _cache_settings() or entry.get('files') != file_stats:
+		return None
+	return entry
+
+def _incremental_entry_path(name):
+	# Keyed by the folder name alone, so the next export's folder of the same conversation finds it
+	return '{}/incremental/{}.json'.format(cache_dir, name)
+
+def read_incremental_entry(name):
+	"""Returns the incremental entry of the conversation folder, or None if there is none or it was made with other parameters"""
+	try:
+		with open(_incremental_entry_path(name)) as f:
+			entry = json.load(f)
+	except (OSError, ValueError):
+		return None
+	return entry if entry.get('settings') == _cache_settings() else None
+
+def write_incremental_entry(name, is_two_people, conversation):
+	_write_json_atomically(_incremental_entry_path(name), {
+		'settings': _cache_settings(),
+		'is_two_people': is_two_people,
+		'newest_timestamp_ms': conversation.summary.newest_timestamp_ms if conversation else None,
+		'conversation': conversation.to_cache_dict() if conversation else None,
+	})
+
+def write_cache_entry(name, file_stats, is_two_people, num_messages, conversation):
+	entry = {
+		'settings': _cache_settings(),
+		'files': file_stats,
+		'is_two_people': is_two_people,
+		'num_messages': num_messages,
+		'conversation': conversation.to_cache_dict() if conversation else None,
+	}
+	_write_json_atomically(_cache_entry_path(name), entry)
+
+def _write_json_atomically(file_path, data):
+	with atomic_path(file_path) as tmp_path, open(tmp_path, 'w') as f:
+		json.dump(data, f, separators=(',', ':'))
+
+###########################################################################
+# Export
+
+# Derived summary values that are exported along with the cached ones
+EXPORTED_SUMMARY_ATTRIBUTES = ['days_spoken', 'average_msg_per_day', 'avg_calls_per_month']
+
+EXPORT_SCHEMA = """
+CREATE TABLE settings (
+	name TEXT PRIMARY KEY,
+	value
+);
+CREATE TABLE conversations (
+	id INTEGER PRIMARY KEY,
+	person TEXT NOT NULL,
+	total_messages INTEGER,
+	my_total_messages INTEGER,
+	my_actual_messages INTEGER,
+	other_messages INTEGER,
+	num_links INTEGER,
+	num_words NUMERIC,
+	num_calls INTEGER,
+	newest_timestamp_ms INTEGER,
+	oldest_timestamp_ms INTEGER,
+	is_group INTEGER,
+	newest_message_time TEXT,
+	oldest_message_time TEXT,
+	days_spoken INTEGER,
+	average_msg_per_day REAL,
+	avg_calls_per_month REAL
+);
+CREATE INDEX conversations_person ON conversations (person);
+CREATE TABLE history (
+	conversation_id INTEGER NOT NULL REFERENCES conversations (id),
+	month TEXT NOT NULL,
+	messages INTEGER,
+	words NUMERIC,
+	calls INTEGER,
+	call_duration INTEGER,
+	PRIMARY KEY (conversation_id, month)
+);
+CREATE INDEX history_month ON history (month);
+CREATE TABLE participants (
+	conversation_id INTEGER NOT NULL REFERENCES conversations (id),
+	name TEXT NOT NULL,
+	messages INTEGER,
+	words NUMERIC,
+	links INTEGER,
+	calls INTEGER,
+	PRIMARY KEY (conversation_id, name)
+);
+CREATE INDEX participants_name ON participants (name);
+CREATE TABLE participant_history (
+	conversation_id INTEGER NOT NULL REFERENCES conversations (id),
+	name TEXT NOT NULL,
+	month TEXT NOT NULL,
+	messages INTEGER,
+	words NUMERIC,
+	PRIMARY KEY (conversation_id, name, month)
+);
+"""
+
+def export_conversations(conversations, file_path):
+	"""
+	Writes the summaries and histories of the conversations to a SQLite database at file_path, replacing any previous export
+	`history.month` holds the period keys of the granularity the history was computed with, which is saved in the `settings` table
+	`participants` has the totals of every sender, and `participant_history` their periods with messages
+	"""
+	summary_columns = ConversationSummary.CACHED_ATTRIBUTES[1:] + ['newest_message_time', 'oldest_message_time'] + EXPORTED_SUMMARY_ATTRIBUTES
+	settings = dict(_cache_settings(), granularity=granularity, path=os.path.abspath(path), since_ms=since_ms, until_ms=until_ms)
+
+	with atomic_path(file_path) as tmp_path:
+		db = sqlite3.connect(tmp_path)
+		try:
+			with db:
+				db.executescript(EXPORT_SCHEMA)
+				# Lists like the link domains as comma separated text
+				db.executemany('INSERT INTO settings VALUES (?, ?)', ((name, ','.join(value) if isinstance(value, list) else value) for (name, value) in settings.items()))
+				for (conversation_id, conversation) in enumerate(conversations):
+					summary = conversation.summary
+					values = [conversation_id, summary.other_person] + [getattr(summary, attr) for attr in summary_columns]
+					# datetimes as ISO strings
+					values = [value.isoformat(' ') if isinstance(value, datetime) else value for value in values]
+					db.execute('INSERT INTO conversations (id, person, {}) VALUES ({})'.format(', '.join(summary_columns), ', '.join('?' * len(values))), values)
+
+					history = conversation.history
+					db.executemany('INSERT INTO history VALUES (?, ?, ?, ?, ?, ?)', (
+						(conversation_id, month, history.num_messages_for_month(month), history.num_words_for_month(month),
+							history.num_calls_for_month(month), history.call_duration_for_month(month))
+						for month in history.message_dates))
+
+					participants = conversation.participants()
+					db.executemany('INSERT INTO participants VALUES (?, ?, ?, ?, ?, ?)', (
+						(conversation_id, participants.names[sender_id], int(participants.num_messages[sender_id]), participants.words(sender_id),
+							int(participants.num_links[sender_id]), int(participants.num_calls[sender_id]))
+						for sender_id in range(len(participants))))
+					(sender_ids, period_idxs) = np.nonzero(participants.period_num_messages)
+					period_words = participants.period_num_words[sender_ids, period_idxs]
+					db.executemany('INSERT INTO participant_history VALUES (?, ?, ?, ?, ?)', (
+						(conversation_id, participants.names[sender_id], participants.periods[period_idx], messages, words if include_call_words else int(words))
+						for (sender_id, period_idx, messages, words) in zip(sender_ids.tolist(), period_idxs.tolist(),
+							participants.period_num_messages[sender_ids, period_idxs].tolist(), period_words.tolist())))
+		finally:
+			db.close()
+
+
+
+###########################################################################
+# Search
+
+def iter_source_messages(sources):
+	"""
+	The raw messages of a MessageStore's `sources`, read from their json files again
+	The messages of files that are gone are empty dicts, so the messages after them still line up with the store
+	"""
+	for (file_path, num_messages) in sources:
+		if not num_messages:
+			continue
+		if not _is_readable_source(file_path):
+			yield from itertools.repeat({}, num_messages)
+			continue
+		with MessageFileReader(file_path) as reader:
+			yield from itertools.islice(reader, num_messages)
+
+def _is_readable_source(file_path):
+	return file_path is not None and os.path.isfile(file_path)
+
+def unreadable_sources(conversations):
+	"""The (conversation, file path, number of messages) of every source whose json file is gone, like one of an earlier export"""
+	return [(conversation, file_path, num_messages) for conversation in conversations for (file_path, num_messages) in conversation.store.sources
+		if num_messages and not _is_readable_source(file_path)]
+
+def print_unreadable_sources(unreadable, up_to=5):
+	print_header('Messages That Can\'t Be Searched')
+	print('{} messages in {} conversations, as their json files are gone.  Run once with -rc to read them from the current export'.format(
+		sum(num_messages for (_, _, num_messages) in unreadable), len({id(conversation) for (conversation, _, _) in unreadable})))
+	for (conversation, file_path, num_messages) in unreadable[:up_to]:
+		print('    {} -- {} messages from {}'.format(conversation.other_person, num_messages, file_path or 'an earlier export'))
+
+def _index_sources(sources):
+	return SearchIndex.build(raw_message.get('content', '') for raw_message in iter_source_messages(sources))
+
+def search_index(conversations, workers=1):
+	"""
+	The SearchIndex of the content of every message of the conversations, with the rows of each conversation after the ones before it
+	The stores don't keep the content, so it is read from the json files again, a conversation per worker.  The index is saved in
+	`cache_dir` like the timeline, and only built again once the conversations change
+	Messages whose json files are gone are left out with a warning, and the index is not saved, so it is built in full once they are back
+	"""
+	key = _conversations_key(conversations)
+	file_path = os.path.join(cache_dir, SEARCH_INDEX_FILE)
+	if use_cache and not rebuild_cache:
+		index = SearchIndex.load(file_path, key)
+		if index is not None:
+			return index
+
+	unreadable = unreadable_sources(conversations)
+	if unreadable:
+		print_unreadable_sources(unreadable)
+
+	sources = [conversation.store.sources for conversation in conversations]
+	if workers > 1:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			indexes = list(executor.map(_index_sources, sources, chunksize=max(1, len(sources) // (workers * 4))))
+		row_offsets = np.cumsum([0] + [len(conversation.store) for conversation in conversations])[:-1].tolist()
+		index = SearchIndex.merge(indexes, row_offsets)
+	else:
+		# In one go, the rows already follow on from conversation to conversation
+		index = _index_sources(itertools.chain.from_iterable(sources))
+	if use_cache and not unreadable:
+		index.save(file_path, key)
+	return index
+
+def search_hits(conversations, index, query, since=None, until=None, people=None):
+	"""
+	The messages that match the query, as a (conversation idxs, timestamps, sent by me) array of each
+	Only messages from `since` up to, but not including, `until` are kept, and if `people` are given, only their conversations
+	"""
+	rows = index.find(query)
+	row_offsets = np.cumsum([0] + [len(conversation.store) for conversation in conversations])
+	conversation_idxs = np.searchsorted(row_offsets, rows, side='right') - 1
+	timestamps = np.concatenate([np.empty(0, dtype=np.int64)] + [np.frombuffer(conversation.store.timestamps, dtype=np.int64) for conversation in conversations])[rows]
+	sent_by_me = np.concatenate([np.empty(0, dtype=np.uint8)] + [np.frombuffer(conversation.store.sent_by_me, dtype=np.uint8) for conversation in conversations])[rows].astype(bool)
+
+	kept = np.ones(len(rows), dtype=bool)
+	if since is not None:
+		kept &= timestamps >= since
+	if until is not None:
+		kept &= timestamps < until
+	if people:
+		kept &= np.isin(conversation_idxs, [idx for (idx, conversation) in enumerate(conversations) if conversation.other_person in people])
+	return (conversation_idxs[kept], timestamps[kept], sent_by_me[kept])
+
+def _top_search_conversations(conversation_idxs, up_to):
+	"""The idxs of the conversations with the most hits, ties in conversation order"""
+	counts = np.bincount(conversation_idxs)
+	return sorted(np.flatnonzero(counts).tolist(), key=lambda idx: -counts[idx])[:up_to]
+
+def print_search(conversations, index, query, up_to=7, since=None, until=None, people=None):
+	"""Prints the number of messages that match the query, in all and in the conversations with the most of them, and per period"""
+	(conversation_idxs, timestamps, sent_by_me) = search_hits(conversations, index, query, since, until, people)
+	print_header('Messages Matching "{}"'.format(query))
+	print('{} in {} conversations ({} sent by me)'.format(len(timestamps), len(np.unique(conversation_idxs)), int(sent_by_me.sum())))
+
+	print_header('Top {} Conversations Matching "{}"'.format(up_to, query))
+	for (rank, idx) in enumerate(_top_search_conversations(conversation_idxs, up_to)):
+		in_conversation = conversation_idxs == idx
+		print(rank+1, '{} -- {} ({} sent by me)'.format(conversations[idx].header_str, int(in_conversation.sum()), int(sent_by_me[in_conversation].sum())))
+
+	print_header('Messages Matching "{}" Per {}'.format(query, granularity.capitalize()))
+	(periods, codes) = period_bins(timestamps, granularity)
+	for (period, count) in zip(periods, np.bincount(codes, minlength=len(periods)).tolist()):
+		print('    {} -- {}'.format(period, count))
+
+def search_figures(conversations, index, queries, up_to=5, bar_mode='group', since=None, until=None, people=None):
+	"""Returns (name, figure) of a bar graph of the messages matching each query over time, for the conversations with the most of them"""
+	import graphs
+	figures = []
+	for (number, query) in enumerate(queries, 1):
+		(conversation_idxs, timestamps, _) = search_hits(conversations, index, query, since, until, people)
+		top_idxs = _top_search_conversations(conversation_idxs, up_to)
+		# Binned like the other graphs, so the bars line up with the history of the same conversations
+		period = graph_period([conversations[idx] for idx in top_idxs])
+		traces = []
+		for idx in top_idxs:
+			(periods, codes) = period_bins(timestamps[conversation_idxs == idx], period)
+			traces.append(graphs.history_bar(conversations[idx].other_person, periods, np.bincount(codes, minlength=len(periods)).tolist()))
+		figure = graphs.bar_figure(traces, 'Messages Matching "{}" Over Time{}'.format(query, _graph_title_suffix(period)),
+			y_axis_title='Number of Messages', bar_mode=bar_mode)
+		# Numbered, as queries that only differ in case or punctuation have the same tokens
+		figures.append(('search-{}-{}'.format(number, '-'.join(tokenize(query))), figure))
+	return figures
+
+
+
+###########################################################################
+# Serving
+
+def query_routes(conversations, up_to=15, sort_mode=TOTAL_MESSAGES_SORT_MODE):
+	"""
+	The routes of `--serve`, which answer from the loaded conversations.  Each takes the dict of query parameters and returns what json encodes
+	The routes that list conversations take `sort` and `top`, defaulting to the command line's, and all of them take `since` and `until`
+	in the formats of the command line
+	"""
+	import server
+	# Only built once a query asks for a time window
+	timelines = []
+
+	def windowed(params):
+		try:
+			since = parse_time_bound(params['since']) if params.get('since') else None
+			until = parse_time_bound(params['until'], is_until=True) if params.get('until') else None
+		except ValueError as e:
+			raise server.QueryError(str(e))
+		if since is None and until is None:
+			return conversations
+		if not timelines:
+			timelines.append(timeline_index(conversations))
+		return window_conversations(conversations, timelines[0], since, until)
+
+	def top(params, conversations):
+		mode = SORT_MODE_ALIASES.get(params.get('sort', sort_mode), params.get('sort', sort_mode))
+		if mode not in SORT_CONFIGS:
+			raise server.QueryError('Unknown sort {!r}, one of {}'.format(mode, ', '.join(SORT_CONFIGS)))
+		# Without the sketches every conversation would count 0 distinct words
+		if mode == DISTINCT_WORDS_SORT_MODE and not vocabulary_sketches:
+			raise server.QueryError('Sorting by {} needs the word sketches, serve with -s {} or -vs'.format(mode, mode))
+		if mode == DISTINCT_WORDS_SORT_MODE and (params.get('since') or params.get('until')):
+			raise server.QueryError('Sorting by {} counts whole conversations, and can\'t be used with since or until'.format(mode))
+		if params.get('person'):
+			named = [conversation for conversation in conversations if conversation.other_person == params['person']]
+			if not named:
+				raise server.QueryError('No conversation with {!r}'.format(params['person']))
+			return named
+		try:
+			num = int(params.get('top', up_to))
+		except ValueError:
+			raise server.QueryError('top must be a number')
+		return top_conversations(conversations, mode, num)
+
+	def sorts(params):
+		"""The sort modes, for `sort`"""
+		return [{'sort': mode, 'type': config['type'], 'reverse': config['reverse']} for (mode, config) in SORT_CONFIGS.items()]
+
+	def summaries(params):
+		"""The summaries of the top conversations (`sort`, `top`, or one `person`)"""
+		return [conversation.summary.to_json_dict() for conversation in top(params, windowed(params))]
+
+	def history(params):
+		"""The messages, words, calls and call duration per period of the top conversations (`granularity`, `sort`, `top`, or one `person`)"""
+		period = params.get('granularity', granularity)
+		if period not in GRANULARITIES:
+			raise server.QueryError('Unknown granularity {!r}, one of {}'.format(period, ', '.join(GRANULARITIES)))
+		series = []
+		for conversation in top(params, windowed(params)):
+			conversation_history = conversation.history_per(period)
+			dates = conversation_history.message_dates
+			series.append({
+				'person': conversation.other_person,
+				'granularity': period,
+				'periods': dates,
+				'messages': [conversation_history.num_messages_for_month(month) for month in dates],
+				'words': [conversation_history.num_words_for_month(month) for month in dates],
+				'calls': [conversation_history.num_calls_for_month(month) for month in dates],
+				'call_duration': [conversation_history.call_duration_for_month(month) for month in dates],
+			})
+		return series
+
+	def starts(params):
+		"""Who started conversations after `hours` (comma separated) without a message, in the top conversations (`sort`, `top`, or one `person`) and in all"""
+		try:
+			hour_thresholds = [float(hours) for hours in params.get('hours', '72').split(',')]
+		except ValueError:
+			raise server.QueryError('hours must be numbers separated by commas')
+		windowed_conversations = windowed(params)
+		totals = {group: [0] * len(hour_thresholds) for group in ConversationStartsIndex.GROUPS}
+		for conversation in windowed_conversations:
+			for (group, counts) in conversation.starts_index().count_starts(hour_thresholds).items():
+				totals[group] = [total + count for (total, count) in zip(totals[group], counts)]
+		return {
+			'hours': hour_thresholds,
+			'conversations': [dict(conversation.starts_index().count_starts(hour_thresholds), person=conversation.other_person)
+				for conversation in top(params, windowed_conversations)],
+			'all': totals,
+		}
+
+	return {'/sorts': sorts, '/summaries': summaries, '/history': history, '/starts': starts}
+
+def write_profiles(profiler, profile_path, code_profile, cprofile_path):
+	"""Writes the `--profile` table and trace and the `--cprofile` stats, whichever are on, once the run is done"""
+	if code_profile:
+		code_profile.disable()
+		code_profile.dump_stats(cprofile_path)
+		print_header('cProfile Stats Written To')
+		print(cprofile_path)
+
+	if profiler.enabled:
+		print_header('Profile')
+		print(profiler.table())
+		profiler.write_trace(profile_path)
+		print_header('Trace Events Written To')
+		print(profile_path)
+
 
 
 ###########################################################################
@@ -561,8 +1985,10 @@ if __name__ == '__main__':
 		help='Relative or absolute path to the location of the conversation folders. Default "./inbox"')
 	parser.add_argument('-i', '--include-threshold', type=int, default=is_worth_including_threshold,
 		help='The smallest number of total messages in a conversation for a conversation to be counted. Default 100')
-	parser.add_argument('-s', '--sort-mode', type=str, default=sort_mode, choices=[TOTAL_MESSAGES_SORT_MODE, WORDS_SORT_MODE, OLDEST_SORT_MODE, IMGUR_LINKS_SORT_MODE], 
-		help='How to sort the messages by.  Default "total"')
+	parser.add_argument('-s', '--sort-mode', type=str, default=sort_mode, choices=[TOTAL_MESSAGES_SORT_MODE, WORDS_SORT_MODE, OLDEST_SORT_MODE, LINKS_SORT_MODE, DISTINCT_WORDS_SORT_MODE] + list(SORT_MODE_ALIASES), 
+		help='How to sort the messages by.  "imgur" is the old name of "links".  "distinct_words" estimates them with the sketches of --vocabulary.  Default "total"')
+	parser.add_argument('-ld', '--link-domains', type=str, default=','.join(link_domains),
+		help='List of domains, separated by comma, that count as links in the summary, the "links" sort mode and the conversation starts. Default "{}"'.format(','.join(link_domains)))
 	parser.add_argument('-t', '--top-people', type=int, default=5,
 		help='The top number of people people to display.  Default 5')
 	parser.add_argument('-f', '--filter', type=str, default='',
@@ -570,7 +1996,7 @@ if __name__ == '__main__':
 
 	# Summary-only
 	parser.add_argument('-so', '--summary-only', action='store_true',
-		help='Print only summary information in command-line.  Do not display graphs')
+		help='Print only summary information in command-line.  Do not display graphs.  Decodes each file in one go instead of streaming it, which is faster but keeps the file in memory')
 	# Pring History
 	parser.add_argument('-ph', '--print-history', action='store_true',
 		help='Print the messaging history per month')
@@ -585,45 +2011,191 @@ if __name__ == '__main__':
 		help='Generate analysis on call graphs')
 	parser.add_argument('-wc', '--words-calls', action='store_true',
 		help='Include call duration in word-count calculations')
+	parser.add_argument('-st', '--starts-thresholds', type=str, default='',
+		help='List of hour thresholds, separated by comma, to count who started conversations after that many hours without a message. If not provided, will not count conversation starts')
+	parser.add_argument('-g', '--granularity', type=str, default=granularity, choices=GRANULARITIES,
+		help='The length of the periods the history is split up in. Weeks start on monday. Default "month"')
+	parser.add_argument('-mp', '--max-points', type=int, default=max_points_per_trace,
+		help='Most points per person in a graph. Longer histories are graphed per week, month, quarter or year instead, whichever is the first to fit. 0 for no limit. Default {}'.format(max_points_per_trace))
+	parser.add_argument('-j', '--workers', type=int, default=1,
+		help='Number of processes to use for loading conversations. Default 1')
+	parser.add_argument('-cd', '--cache-dir', type=str, default=cache_dir,
+		help='Directory to save the computed conversation data in, so unchanged conversations are not parsed again. Default "./.analysis-cache"')
+	parser.add_argument('-nc', '--no-cache', action='store_true',
+		help='Do not read or write the analysis cache')
+	parser.add_argument('-rc', '--rebuild-cache', action='store_true',
+		help='Parse every conversation again and overwrite the analysis cache')
+	parser.add_argument('-inc', '--incremental', action='store_true',
+		help='Keep the analysis of each conversation by folder name in the cache directory, and only add the messages newer than the last run. For exports that contain the previous ones. Ignored with --no-cache')
+	parser.add_argument('-rd', '--render-dir', type=str, default='',
+		help='Directory to write the graphs to as files, instead of opening them. If not provided, will show the graphs')
+	parser.add_argument('-rf', '--render-format', type=str, default=HTML_RENDER_FORMAT, choices=RENDER_FORMATS,
+		help='Format of the graphs written to the render directory. "html" pages share one plotly.js file, "json" writes the plotly figure specs. Default "html"')
+	parser.add_argument('-pf', '--profile', type=str, nargs='?', default='', const='profile.json',
+		help='Print the wall time, CPU time, MB read, messages per second and peak memory of each stage and the slowest conversations, and write them as trace events to the given file. Default file "profile.json"')
+	parser.add_argument('-cp', '--cprofile', type=str, default='',
+		help='Run the analysis under cProfile and write the stats to the given file, for `python -m pstats`. With -j, the loading happens in other processes and is not included')
+	parser.add_argument('-gc', '--group-chats', action='store_true',
+		help='Analyze group conversations too, named by their title. If not provided, only conversations between two people are analyzed')
+	parser.add_argument('-pp', '--participants', type=int, default=0,
+		help='Print the messages, words, links and calls of this many participants with the most messages in each of the top conversations. Default 0, which prints none')
+	parser.add_argument('-vs', '--vocabulary', type=int, default=0,
+		help='Print the tokens, distinct words and this many most used words of each side of the top conversations and of all of them, counted with bounded-memory sketches. Default 0, which prints none')
+	parser.add_argument('-si', '--since', type=str, default='',
+		help='Only analyze the messages from this date on: YYYY-MM-DD, YYYY-MM, YYYY-Qn, YYYY, or Nd for N days ago. If not provided, starts at the oldest message')
+	parser.add_argument('-un', '--until', type=str, default='',
+		help='Only analyze the messages up to and including this date, in the same formats as --since. If not provided, goes up to the newest message')
+	parser.add_argument('-sr', '--search', type=str, default='',
+		help='List of words or phrases, separated by comma, to count the messages containing. Prints them per conversation and period, and graphs them over time. If not provided, will not search')
+	parser.add_argument('-sv', '--serve', type=str, nargs='?', default='', const='localhost:8000',
+		help='Load the conversations once and answer HTTP/JSON queries for summaries, histories, sorts and conversation starts on this [host:]port, instead of printing. Default "localhost:8000"')
+	parser.add_argument('-e', '--export', type=str, default='',
+		help='Path of a SQLite database to write the summary and history of every included conversation to, for querying later. If not provided, will not export')
 
 	args = parser.parse_args()
 	
 	my_facebook_name = args.my_name
 	path = args.path
 	is_worth_including_threshold = args.include_threshold
-	sort_mode = args.sort_mode
+	sort_mode = SORT_MODE_ALIASES.get(args.sort_mode, args.sort_mode)
+	link_domains = args.link_domains.split(',') if len(args.link_domains) > 0 else []
 	num_to_display = args.top_people
 	filtered_list = args.filter.split(',') if len(args.filter) > 0 else []
 	summary_only = args.summary_only
+	whole_file_size = WHOLE_FILE_SIZE if summary_only else 0
 	use_words = args.word_count
 	bar_mode = args.bar_mode
 	print_history = args.print_history
 	display_relative = args.relative_graphs
 	calls_graphs = args.calls
+	workers = args.workers
+	granularity = args.granularity
+	max_points_per_trace = args.max_points
+	starts_thresholds = [float(hours) for hours in args.starts_thresholds.split(',')] if len(args.starts_thresholds) > 0 else []
+	cache_dir = args.cache_dir
+	use_cache = not args.no_cache
+	rebuild_cache = args.rebuild_cache
+	# Without the cache there is no earlier run to add to, so every message gets read like without -inc
+	incremental = args.incremental and use_cache
+	include_groups = args.group_chats
+	participants_shown = args.participants
+	vocabulary_shown = args.vocabulary
+	# Sorting by distinct words needs the sketches too
+	vocabulary_sketches = vocabulary_shown > 0 or sort_mode == DISTINCT_WORDS_SORT_MODE
+	try:
+		since_ms = parse_time_bound(args.since) if args.since else None
+		until_ms = parse_time_bound(args.until, is_until=True) if args.until else None
+	except ValueError as e:
+		parser.error(str(e))
+	if vocabulary_sketches and (since_ms is not None or until_ms is not None):
+		parser.error('--vocabulary and the distinct_words sort count whole conversations, and can\'t be used with --since or --until')
+	export_path = args.export
+	search_queries = [query for query in args.search.split(',') if tokenize(query)] if len(args.search) > 0 else []
+	(serve_host, _, serve_port) = args.serve.rpartition(':')
+	serve_host = serve_host or 'localhost'
+	if args.serve and not serve_port.isdigit():
+		parser.error('--serve takes [host:]port, not {!r}'.format(args.serve))
+	render_dir = args.render_dir
+	render_format = args.render_format
+	profile_path = args.profile
+	cprofile_path = args.cprofile
 
 	# Note this is global var
 	include_call_words = args.words_calls
 
-	
-	conversations = get_conversations()
+
+	profiler = Profiler(enabled=bool(profile_path))
+	code_profile = cProfile.Profile() if cprofile_path else None
+	if code_profile:
+		code_profile.enable()
+
+	with profiler.stage('load') as stage:
+		conversations = get_conversations(workers=workers, profiler=profiler)
+		stage['bytes'] = sum(conversation['bytes'] for conversation in profiler.conversations)
+		stage['messages'] = sum(conversation['messages'] for conversation in profiler.conversations)
+	# The search index is over the conversations as loaded, as it needs the files of all their messages
+	loaded_conversations = conversations
+	if since_ms is not None or until_ms is not None:
+		with profiler.stage('window') as stage:
+			timeline = timeline_index(conversations)
+			conversations = window_conversations(conversations, timeline, since_ms, until_ms)
+			stage['messages'] = sum(len(conversation.store) for conversation in conversations)
+		print_header('Messages In The Time Window')
+		print('{} in {} conversations ({} sent by me)'.format(stage['messages'], len(conversations), timeline.sender_count(my_facebook_name, since_ms, until_ms)))
 	if len(filtered_list) > 0:
 		print_header('Filtering Conversations Down To Top {} of {} Given Names'.format(num_to_display, len(filtered_list)))
 		conversations = [conv for conv in conversations if conv.other_person in filtered_list]
 
-
-	print_summary_data(conversations, up_to=num_to_display, sort_mode=sort_mode)
+	if args.serve:
+		import server
+		print_header('Answering Queries On')
+		print('http://{}:{}/'.format(serve_host, serve_port))
+		with profiler.stage('serve'):
+			query_server = server.serve(query_routes(conversations, up_to=num_to_display, sort_mode=sort_mode), serve_host, int(serve_port))
+		print_header('Queries Answered')
+		print('{} ({} from the response cache)'.format(query_server.num_requests, query_server.cache.hits))
+		write_profiles(profiler, profile_path, code_profile, cprofile_path)
+		sys.exit()
+
+	with profiler.stage('summary'):
+		print_summary_data(conversations, up_to=num_to_display, sort_mode=sort_mode)
+
+	if participants_shown > 0:
+		with profiler.stage('participants'):
+			print_header('Participants With The Most Messages')
+			print_participants(conversations, up_to=num_to_display, sort_mode=sort_mode, participants_shown=participants_shown)
+
+	if vocabulary_shown > 0:
+		with profiler.stage('vocabulary'):
+			print_header('Vocabulary Of Each Side')
+			print_vocabulary(conversations, up_to=num_to_display, sort_mode=sort_mode, words_shown=vocabulary_shown)
+
+	if search_queries:
+		with profiler.stage('search'):
+			index = search_index(loaded_conversations, workers=workers)
+			for query in search_queries:
+				print_search(loaded_conversations, index, query, up_to=num_to_display, since=since_ms, until=until_ms, people=filtered_list)
+
+	if export_path:
+		with profiler.stage('export'):
+			export_conversations(conversations, export_path)
+		print_header('Exported {} Conversations To'.format(len(conversations)))
+		print(export_path)
+
+	if len(starts_thresholds) > 0:
+		with profiler.stage('starts'):
+			print_header('Conversation Starts After Hours Without Messages')
+			print_conversation_starts_sweep(conversations, starts_thresholds, up_to=num_to_display, sort_mode=sort_mode)
 	
 	if not summary_only:
 		
 		if print_history:
-			print_header('Messaging History in Total Messages Per Month')
-			print_messaging_history(conversations, up_to=num_to_display, sort_mode=sort_mode)
-
-			if use_words:
-				print_header('Messaging History in Total Words Per Month')
-				print_messaging_history_words_per_month(conversations, up_to=num_to_display, sort_mode=sort_mode)
+			with profiler.stage('history'):
+				print_header('Messaging History in Total Messages Per {}'.format(granularity.capitalize()))
+				print_messaging_history(conversations, up_to=num_to_display, sort_mode=sort_mode)
+
+				if use_words:
+					print_header('Messaging History in Total Words Per {}'.format(granularity.capitalize()))
+					print_messaging_history_words_per_month(conversations, up_to=num_to_display, sort_mode=sort_mode)
+
+		with profiler.stage('graphs'):
+			figures = conversations_bar_figures(conversations, up_to=num_to_display, sort_mode=sort_mode, use_words=use_words, bar_mode=bar_mode, calls_graphs=calls_graphs)
+			if display_relative:
+				figures += conversations_relative_percent_figures(conversations, up_to=num_to_display, sort_mode=sort_mode, use_words=use_words)
+			if search_queries:
+				figures += search_figures(loaded_conversations, index, search_queries, up_to=num_to_display, bar_mode=bar_mode, since=since_ms, until=until_ms, people=filtered_list)
+
+		if render_dir:
+			with profiler.stage('render'):
+				render_figures(figures, render_dir, render_format=render_format, workers=workers)
+			print_header('Rendered {} Graphs To'.format(len(figures)))
+			print(render_dir)
+		else:
+			with profiler.stage('show'):
+				for (_, figure) in figures:
+					figure.show()
 
-		display_conversations_as_bars(conversations, up_to=num_to_display, sort_mode=sort_mode, use_words=use_words, bar_mode=bar_mode, calls_graphs=calls_graphs)
+	print_header('Conversations With Their History Built')
+	print('{} of {}'.format(sum(1 for conversation in conversations if conversation.has_history()), len(conversations)))
 
-		if display_relative:
-			display_conversations_relative_percents(conversations, up_to=num_to_display, sort_mode=sort_mode, use_words=use_words)
+	write_profiles(profiler, profile_path, code_profile, cprofile_path)
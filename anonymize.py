@@ -2,11 +2,17 @@
 
 """
 A simple script to create an anonymous facebook message conversation of two people out of an actual one
+It can also anonymize every two-person conversation of an inbox at once, see `print_usage`
 """
 
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import json
 import sys
 import os
+import time
+
+from json_stream import MessageFileReader
 
 ###########################################################################
 # Parameters
@@ -21,9 +27,27 @@ other_name = ''
 # optional
 anonymous_name = 'anonymous'
 
+# inbox mode
+workers = 1
+
 ###########################################################################
 # Constants
 
+# Inbox mode writes json without any whitespace
+COMPACT_SEPARATORS = (',', ':')
+
+# Keys whose values are blanked wherever they appear in a message
+SCRUBBED_KEYS = ('uri', 'actor')
+
+# How deep dicts get scrubbed recursively before switching to an explicit stack, well below the recursion limit
+MAX_RECURSION_DEPTH = 100
+
+# Values of the keys other than `participants` and `messages` in an anonymized file
+ANONYMOUS_HEADER = {
+	'title': 'Anonymous Conversation',
+	'thread_path': '',
+}
+
 LOREM_IPSUM = """
 Lorem ipsum dolor sit amet, consectetur adipiscing elit. Pellentesque et dolor libero. Nunc sit amet elit vestibulum lacus dapibus feugiat eu id sem. Etiam euismod volutpat risus at egestas. Nunc commodo sodales enim eu placerat. Aliquam luctus, ex sit amet bibendum tempus, nunc nibh auctor nulla, vitae laoreet lectus nulla in lacus. Nunc tempus tempor ipsum vitae porta. Donec posuere, ligula nec sodales porttitor, sem lacus fermentum ex, id condimentum lacus velit vitae neque. In hac habitasse platea dictumst. Phasellus tincidunt nibh odio, ac vehicula quam cursus eu. Duis condimentum dictum lorem eget dapibus. Donec imperdiet ullamcorper consequat.
 Nunc fringilla mauris eget gravida scelerisque. Proin fringilla nulla in velit sollicitudin, ut varius purus tincidunt. Nullam id consequat nisi. Mauris non dui et augue ultrices aliquet molestie ut mauris. Phasellus eu nisl ultrices, maximus dolor at, ultricies ex. Maecenas nec nulla feugiat, mollis ex ac, dignissim augue. Nulla feugiat mi vel tristique laoreet. Proin scelerisque ligula ligula, vel ornare velit accumsan nec. Vivamus tristique nisi ac diam vehicula lobortis.
@@ -56,71 +80,261 @@ def print_usage():
     	{file} - Relative or absolute path to file
     	{my_name} - Your name as it appears in the file
     	{other_name} - Other person's name as it appears in the file
-    	[anonymous_name] - (Optional) Name for output of the file
+    	[anonymous_name] - (Optional) Name for output of the file\n
+    	./anonymize.py --inbox {inbox} {out_dir} {my_name} [anonymous_name] [-j WORKERS]\n
+    	{inbox} - Folder with one folder per conversation, like the messages/inbox folder of the export
+    	{out_dir} - Folder to write the anonymized conversations to, one folder per conversation
+    	{my_name} - Your name as it appears in the files
+    	[anonymous_name] - (Optional) Prefix for the other person's name and the output folders
+    	[-j WORKERS] - (Optional) Number of processes to anonymize conversations with
     	""")
 
 
-def anonymize_uris_actors(msg_dict):
-	for key in msg_dict.keys():
-		
-		if key in ['uri', 'actor']:
-			msg_dict[key] = ''
-		else:
-			attr = msg_dict[key]
-			if type(attr) is list:
-				for i in range(len(attr)):
-					if type(attr[i]) is dict:
-						anonymize_uris_actors(attr[i])
-					else:
-						attr[i] = ''
-					
-			elif type(attr) is dict:
-				anonymize_uris_actors(attr)
+def anonymize_uris_actors(message):
+	"""Blanks every `uri` and `actor` in a message, along with every list item that isn't a dict"""
+	_anonymize_dict(message, 0)
 
-###########################################################################
-# Main Script
 
+def _anonymize_dict(value, depth):
+	"""
+	Recursive, which is the fastest for the few levels messages have
+	Past `MAX_RECURSION_DEPTH` the rest is handed to `_anonymize_nested`, so deep payloads can't hit the recursion limit
+	"""
+	if depth > MAX_RECURSION_DEPTH:
+		_anonymize_nested([value])
+		return
+	# Indexing is faster than unpacking the pairs of `items()` and `enumerate()` here, and comparing
+	# with the SCRUBBED_KEYS one by one faster than looking them up in the tuple
+	for key in value:
+		if key == 'uri' or key == 'actor':
+			value[key] = ''
+			continue
+		item = value[key]
+		if type(item) is list:
+			for i in range(len(item)):
+				element = item[i]
+				if type(element) is dict:
+					_anonymize_dict(element, depth + 1)
+				else:
+					item[i] = ''
+		elif type(item) is dict:
+			_anonymize_dict(item, depth + 1)
 
-if len(sys.argv) not in [4, 5]:
-	print_usage()
-	exit(1)
 
-file = sys.argv[1]
-my_name = sys.argv[2]
-other_name = sys.argv[3]
-if len(sys.argv) == 5:
-	anonymous_name = sys.argv[4]
+def _anonymize_nested(stack):
+	"""Blanks uris, actors and non-dict list items at any depth, with a stack instead of recursion"""
+	while stack:
+		value = stack.pop()
+		if type(value) is dict:
+			for (key, item) in value.items():
+				if key in SCRUBBED_KEYS:
+					value[key] = ''
+				elif type(item) is dict or type(item) is list:
+					stack.append(item)
+		else:
+			for (i, item) in enumerate(value):
+				if type(item) is dict:
+					stack.append(item)
+				else:
+					value[i] = ''
 
-with open(file) as f:
-	data = json.load(f)
-	assert len(data['participants']) == 2, 'Can only anonymize conversations of two people currently'
-	participants = [participant['name'] for participant in data['participants']]
-	assert my_name in participants and other_name in participants, 'my_name and other_name should be participants of conversation'
 
-	for participant in data['participants']:
+def anonymize_header(header, other_name, anonymous_name):
+	"""
+	Anonymizes the keys of a file other than `messages`
+	Only keys that are present are replaced, since the streamed files are split around the messages
+	"""
+	for participant in header.get('participants', []):
 		participant['name'] = anonymous_name if participant['name'] == other_name else 'Me'
 
+	for (key, value) in ANONYMOUS_HEADER.items():
+		if key in header:
+			header[key] = value
 
-	data['title'] = 'Anonymous Conversation'
-	data['thread_path'] = ''
 
-	lorem = 0
-	for message in data['messages']:
-		message['sender_name'] = anonymous_name if message['sender_name'] == other_name else 'Me'
-		if message.get('content'):
-			content = message['content'].split()
-			for i in range(len(content)):
-				content[i] = LOREM_IPSUM[lorem % len(LOREM_IPSUM)]
-				lorem += 1
+def anonymize_message(message, other_name, anonymous_name, lorem):
+	"""Anonymizes a message in place.  Returns the position in LOREM_IPSUM for the next message"""
+	message['sender_name'] = anonymous_name if message['sender_name'] == other_name else 'Me'
+	if message.get('content'):
+		content = message['content'].split()
+		for i in range(len(content)):
+			content[i] = LOREM_IPSUM[lorem % len(LOREM_IPSUM)]
+			lorem += 1
+
+		lorem = lorem % len(LOREM_IPSUM)
+		
+		message['content'] = ' '.join(content)
 
-			lorem = lorem % len(LOREM_IPSUM)
-			
-			message['content'] = ' '.join(content)
+	anonymize_uris_actors(message)
+	return lorem
+
+
+def anonymize_file(file, my_name, other_name, anonymous_name):
+	"""Anonymizes a single file, writing it next to the original as `{anonymous_name}-{file_name}`"""
+	with open(file) as f:
+		data = json.load(f)
+	assert len(data['participants']) == 2, 'Can only anonymize conversations of two people currently'
+	participants = [participant['name'] for participant in data['participants']]
+	assert my_name in participants and other_name in participants, 'my_name and other_name should be participants of conversation'
 
-		anonymize_uris_actors(message)
+	anonymize_header(data, other_name, anonymous_name)
+	for (key, value) in ANONYMOUS_HEADER.items():
+		data.setdefault(key, value)
 
+	lorem = 0
+	for message in data['messages']:
+		lorem = anonymize_message(message, other_name, anonymous_name, lorem)
 
 	(path, file_name) = os.path.split(file)
 	new_filename = '{}/{}-{}'.format(path, anonymous_name, file_name)
 	with open(new_filename, 'w') as new_file:
 		json.dump(data, new_file, indent=4)
+
+
+def _member(key, value):
+	return '{}:{}'.format(json.dumps(key), json.dumps(value, separators=COMPACT_SEPARATORS))
+
+
+def stream_anonymized_file(file_path, out_path, other_name, anonymous_name, lorem):
+	"""
+	Anonymizes `file_path` one message at a time, writing compact json to `out_path`
+	Keys keep their order from the original file
+	Returns the position in LOREM_IPSUM to continue from and the number of messages
+	"""
+	num_messages = 0
+	with MessageFileReader(file_path, whole_file_size=0) as reader, open(out_path, 'w') as out:
+		out.write('{')
+		anonymize_header(reader.header, other_name, anonymous_name)
+		leading_keys = list(reader.header)
+		for key in leading_keys:
+			out.write(_member(key, reader.header[key]) + ',')
+
+		out.write('"messages":[')
+		for message in reader:
+			if num_messages:
+				out.write(',')
+			lorem = anonymize_message(message, other_name, anonymous_name, lorem)
+			out.write(json.dumps(message, separators=COMPACT_SEPARATORS))
+			num_messages += 1
+		out.write(']')
+
+		# `header` now also has the keys after the messages
+		trailing = {key: value for (key, value) in reader.header.items() if key not in leading_keys}
+		anonymize_header(trailing, other_name, anonymous_name)
+		for (key, value) in ANONYMOUS_HEADER.items():
+			if key not in reader.header:
+				trailing[key] = value
+		for (key, value) in trailing.items():
+			out.write(',' + _member(key, value))
+		out.write('}')
+
+	return (lorem, num_messages)
+
+
+def conversation_other_name(folder, my_name):
+	"""
+	The other person's name in a conversation folder, found in the header of its first file without reading the messages
+	None for group chats, conversations without my_name and folders without json files
+	"""
+	files = sorted(file_name for file_name in os.listdir(folder) if '.json' in file_name)
+	if not files:
+		return None
+
+	with MessageFileReader(os.path.join(folder, files[0])) as reader:
+		names = [participant['name'] for participant in reader.header.get('participants', [])]
+	if len(names) != 2 or my_name not in names:
+		return None
+	return names[0] if names[1] == my_name else names[1]
+
+
+def anonymize_conversation(folder, out_folder, my_name, anonymous_name):
+	"""
+	Anonymizes every file of a conversation folder into `out_folder`
+	The LOREM_IPSUM position carries over between the files in name order, so the output only depends on the conversation
+	Returns None for group chats and conversations without my_name, otherwise the number of files, messages and bytes read and written
+	"""
+	other_name = conversation_other_name(folder, my_name)
+	if other_name is None:
+		return None
+
+	files = sorted(file_name for file_name in os.listdir(folder) if '.json' in file_name)
+	os.makedirs(out_folder, exist_ok=True)
+	lorem = 0
+	num_messages = 0
+	bytes_read = 0
+	bytes_written = 0
+	for file_name in files:
+		file_path = os.path.join(folder, file_name)
+		out_path = os.path.join(out_folder, file_name)
+		(lorem, file_messages) = stream_anonymized_file(file_path, out_path, other_name, anonymous_name, lorem)
+		num_messages += file_messages
+		bytes_read += os.path.getsize(file_path)
+		bytes_written += os.path.getsize(out_path)
+
+	return (len(files), num_messages, bytes_read, bytes_written)
+
+
+def _anonymize_conversation_job(job):
+	return anonymize_conversation(*job)
+
+
+def anonymize_inbox(inbox, out_dir, my_name, anonymous_name, workers=1):
+	"""
+	Anonymizes every two-person conversation in `inbox`
+	Conversation i (in folder name order) is written to `{out_dir}/{anonymous_name}-{i}` with `{anonymous_name}-{i}` as the other person's name
+	Only the conversations that get written are counted in i, so the numbers have no gaps
+	"""
+	start = time.perf_counter()
+	folders = sorted(name for name in os.listdir(inbox) if os.path.isdir(os.path.join(inbox, name)))
+	# Only the headers are read to skip the other conversations before numbering
+	included = [name for name in folders if conversation_other_name(os.path.join(inbox, name), my_name) is not None]
+	jobs = []
+	for (i, name) in enumerate(included):
+		conversation_name = '{}-{}'.format(anonymous_name, i + 1)
+		jobs.append((os.path.join(inbox, name), os.path.join(out_dir, conversation_name), my_name, conversation_name))
+
+	if workers > 1:
+		with ProcessPoolExecutor(max_workers=workers) as executor:
+			results = list(executor.map(_anonymize_conversation_job, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+	else:
+		results = list(map(_anonymize_conversation_job, jobs))
+	elapsed = time.perf_counter() - start
+
+	results = [result for result in results if result is not None]
+	num_files = sum(result[0] for result in results)
+	num_messages = sum(result[1] for result in results)
+	bytes_read = sum(result[2] for result in results)
+	bytes_written = sum(result[3] for result in results)
+
+	print('Anonymized {} of {} conversations into {} (the rest are group chats or do not include {})'.format(len(results), len(folders), out_dir, my_name))
+	print('{} files, {} messages, {:.1f} MB read, {:.1f} MB written in {:.2f}s'.format(num_files, num_messages, bytes_read / 1e6, bytes_written / 1e6, elapsed))
+	print('{:.0f} messages/s, {:.1f} MB/s'.format(num_messages / elapsed if elapsed else 0, bytes_read / 1e6 / elapsed if elapsed else 0))
+
+###########################################################################
+# Main Script
+
+if __name__ == '__main__':
+	if sys.argv[1:2] == ['--inbox']:
+		parser = argparse.ArgumentParser(prog='anonymize.py --inbox', description='Anonymize every two-person conversation of an inbox')
+		parser.add_argument('inbox')
+		parser.add_argument('out_dir')
+		parser.add_argument('my_name')
+		parser.add_argument('anonymous_name', nargs='?', default=anonymous_name)
+		parser.add_argument('-j', '--workers', type=int, default=workers,
+			help='Number of processes to anonymize conversations with. Default {}'.format(workers))
+		args = parser.parse_args(sys.argv[2:])
+
+		anonymize_inbox(args.inbox, args.out_dir, args.my_name, args.anonymous_name, workers=args.workers)
+		exit(0)
+
+	if len(sys.argv) not in [4, 5]:
+		print_usage()
+		exit(1)
+
+	file = sys.argv[1]
+	my_name = sys.argv[2]
+	other_name = sys.argv[3]
+	if len(sys.argv) == 5:
+		anonymous_name = sys.argv[4]
+
+	anonymize_file(file, my_name, other_name, anonymous_name)
@@ -0,0 +1,27 @@
+"""
+Writing the cache entries, indexes and exports of analyze-messages.py so an interrupted or failed write never leaves a half-written file
+"""
+
+from contextlib import contextmanager
+import os
+
+###########################################################################
+
+@contextmanager
+def atomic_path(file_path):
+	"""
+	Yields a temporary path next to `file_path` to write to.  Once the block is done it replaces `file_path`,
+	and if the block fails, it is removed and `file_path` is left as it was
+	"""
+	os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+	# The pid keeps the worker processes that write at the same time apart
+	tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+	# Left over from a run that was killed, and sqlite would open it instead of starting a new database
+	if os.path.exists(tmp_path):
+		os.remove(tmp_path)
+	try:
+		yield tmp_path
+		os.replace(tmp_path, file_path)
+	finally:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
@@ -0,0 +1,798 @@
+#! /usr/bin/env python3
+
+"""
+Benchmarks for analyze-messages.py and anonymize.py
+
+    ./benchmark.py generate {out_dir}   Write a synthetic inbox that looks like a facebook messenger export
+    ./benchmark.py stages [--path DIR]  Time loading, summary, history, sort and anonymize stages on an inbox
+    ./benchmark.py read [--path DIR]    Streaming the json files one message at a time against decoding each file in one go
+    ./benchmark.py startup [--path DIR] Whole runs on a small inbox, checking that the text-only ones never import plotly
+    ./benchmark.py serve [--path DIR]   Latency of the --serve queries, computed and from the response cache, against a --summary-only run
+    ./benchmark.py sketches             The vocabulary sketches against exact counts on Zipf distributed words
+    ./benchmark.py fused [--scale N]    Single-pass MessageStore against the old per-message classes
+    ./benchmark.py scrub [-m N]         anonymize.py's uri/actor scrubbing against the old recursive function on media-heavy messages
+    ./benchmark.py links [-m N]         Which shared links count for --link-domains, and how fast they are counted
+"""
+
+import argparse
+import collections
+import contextlib
+import copy
+from datetime import datetime
+import http.client
+import importlib.util
+import json
+import os
+import pickle
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from json_stream import WHOLE_FILE_SIZE
+from profiling import PeakRSS
+from sketches import WordSketch, hash_words
+
+###########################################################################
+# Parameters
+
+# The name used for "me" in the bundled example conversations
+my_name = 'Me'
+
+path = './inbox'
+
+# Defaults of the synthetic inbox generator
+num_conversations = 200
+messages_per_conversation = 2000
+messages_per_file = 10000
+group_fraction = 0.3
+call_fraction = 0.02
+share_fraction = 0.05
+imgur_fraction = 0.3
+photo_fraction = 0.05
+
+###########################################################################
+# Constants
+
+WORDS = """
+lorem ipsum dolor sit amet consectetur adipiscing elit pellentesque et libero nunc vestibulum lacus dapibus feugiat eu id sem
+etiam euismod volutpat risus at egestas commodo sodales enim placerat aliquam luctus ex bibendum tempus nibh auctor nulla vitae
+""".split()
+
+SHARE_DOMAINS = ['https://www.youtube.com/watch?v=', 'https://open.spotify.com/track/', 'https://www.reddit.com/r/', 'https://en.wikipedia.org/wiki/']
+
+IMGUR_LINK = 'https://imgur.com/gallery/'
+
+# Facebook exports are indented like this
+EXPORT_INDENT = 2
+
+###########################################################################
+# Helpers
+
+def script_path(file_name):
+	"""The path of one of the scripts next to this one"""
+	return os.path.join(os.path.dirname(os.path.abspath(__file__)), file_name)
+
+def load_analyze_messages():
+	"""analyze-messages.py can't be imported by name because of the dash"""
+	spec = importlib.util.spec_from_file_location('analyze_messages', script_path('analyze-messages.py'))
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	module.my_facebook_name = my_name
+	return module
+
+def read_messages(folder):
+	"""All the raw message dicts of a conversation folder, newest first"""
+	messages = []
+	for file_name in sorted(name for name in os.listdir(folder) if '.json' in name):
+		with open(os.path.join(folder, file_name)) as f:
+			messages.extend(json.load(f)['messages'])
+	return messages
+
+@contextlib.contextmanager
+def benchmark_inbox(args):
+	"""
+	Yields (inbox, tmp_dir).  The inbox is `--path`, or if none is given, a synthetic inbox generated with the generator options
+	in the temporary directory, which gets removed afterwards
+	"""
+	tmp_dir = tempfile.mkdtemp(prefix='messenger-benchmark-')
+	try:
+		inbox = args.path
+		if not inbox:
+			inbox = os.path.join(tmp_dir, 'inbox')
+			generate_inbox(inbox, args.conversations, args.messages, args.per_file, args.groups, args.calls, args.shares, args.imgur, args.photos, args.seed)
+		yield (inbox, tmp_dir)
+	finally:
+		shutil.rmtree(tmp_dir)
+
+def load_stores(analyze, inbox, whole_file_size=0):
+	"""A MessageStore of every two-person conversation of the inbox, with its files read by MessageFileReaders"""
+	stores = []
+	for name in sorted(os.listdir(inbox)):
+		store = analyze.MessageStore()
+		files = sorted(file_name for file_name in os.listdir(os.path.join(inbox, name)) if '.json' in file_name)
+		for file_name in files:
+			file_path = os.path.join(inbox, name, file_name)
+			with analyze.MessageFileReader(file_path, whole_file_size=whole_file_size) as reader:
+				if len(reader.header['participants']) == 2:
+					store.add_messages(reader, file_path)
+		if len(store):
+			stores.append(store)
+	return stores
+
+def scale_messages(messages, scale):
+	"""
+	Repeats the conversation `scale` times, each copy shifted to before the previous one, so the result looks like one long conversation
+	"""
+	span = messages[0]['timestamp_ms'] - messages[-1]['timestamp_ms'] + 1
+	scaled = []
+	for copy_index in range(scale):
+		for message in messages:
+			message = dict(message)
+			message['timestamp_ms'] -= copy_index * span
+			scaled.append(message)
+	return scaled
+
+def best_time(func, repeat):
+	"""Runs func `repeat` times.  Returns (best wall time in seconds, result of the last run)"""
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = func()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best, result
+
+###########################################################################
+# Synthetic inbox
+
+def generate_inbox(out_dir, conversations=num_conversations, messages=messages_per_conversation, per_file=messages_per_file,
+		groups=group_fraction, calls=call_fraction, shares=share_fraction, imgur=imgur_fraction, photos=photo_fraction, seed=0):
+	"""
+	Writes `conversations` folders to out_dir, each with `message_1..N.json` files of at most `per_file` messages, newest first like facebook does
+	Each conversation gets between half and one and a half times `messages` messages
+	`groups` of the conversations have 3-12 participants. Of the messages, `calls` are calls, `shares` are shares of which `imgur` are imgur links,
+	and `photos` are photos
+	Returns the total number of messages written
+	"""
+	rng = random.Random(seed)
+	total = 0
+	for idx in range(conversations):
+		is_group = rng.random() < groups
+		others = ['Person {}'.format(idx)]
+		if is_group:
+			others += ['Person {}-{}'.format(idx, member) for member in range(rng.randint(2, 11))]
+		participants = [{'name': name} for name in others + [my_name]]
+
+		folder_name = 'person{}_{}'.format(idx, rng.randint(10 ** 9, 10 ** 10 - 1))
+		folder = os.path.join(out_dir, folder_name)
+		os.makedirs(folder, exist_ok=True)
+
+		num_messages = rng.randint(messages // 2, messages * 3 // 2) if messages > 1 else messages
+		timestamp_ms = 1577836800000 - rng.randint(0, 365 * 24 * 60 * 60 * 1000)
+		message_list = []
+		for _ in range(num_messages):
+			# Mostly quick back and forth, sometimes days of silence
+			timestamp_ms -= int(rng.expovariate(1 / 120000)) if rng.random() < 0.9 else rng.randint(3600000, 14 * 24 * 3600000)
+			message_list.append(_generate_message(rng, timestamp_ms, rng.choice(others + [my_name]), calls, shares, imgur, photos))
+
+		num_files = max(1, -(-num_messages // per_file))
+		for file_idx in range(num_files):
+			data = {
+				'participants': participants,
+				'messages': message_list[file_idx * per_file:(file_idx + 1) * per_file],
+				'title': ', '.join(others),
+				'is_still_participant': True,
+				'thread_type': 'RegularGroup' if is_group else 'Regular',
+				'thread_path': 'inbox/{}'.format(folder_name),
+			}
+			with open(os.path.join(folder, 'message_{}.json'.format(file_idx + 1)), 'w') as f:
+				json.dump(data, f, indent=EXPORT_INDENT)
+		total += num_messages
+	return total
+
+def _generate_message(rng, timestamp_ms, sender_name, calls, shares, imgur, photos):
+	message = {'sender_name': sender_name, 'timestamp_ms': timestamp_ms}
+	kind = rng.random()
+	if kind < calls:
+		message['content'] = '{} called you.'.format(sender_name)
+		message['call_duration'] = 0 if rng.random() < 0.3 else rng.randint(1, 7200)
+		message['type'] = 'Call'
+	elif kind < calls + shares:
+		link = IMGUR_LINK if rng.random() < imgur else rng.choice(SHARE_DOMAINS)
+		message['share'] = {'link': link + str(rng.randint(0, 10 ** 6))}
+		message['type'] = 'Share'
+	elif kind < calls + shares + photos:
+		message['photos'] = [{'uri': 'messages/inbox/photos/{}.jpg'.format(rng.randint(0, 10 ** 9)), 'creation_timestamp': timestamp_ms // 1000}
+			for _ in range(rng.randint(1, 4))]
+		message['type'] = 'Generic'
+	else:
+		message['content'] = ' '.join(rng.choice(WORDS) for _ in range(int(rng.expovariate(1 / 8)) + 1))
+		message['type'] = 'Generic'
+
+	if rng.random() < 0.05:
+		message['reactions'] = [{'reaction': '\u00f0\u009f\u0098\u0086', 'actor': sender_name}]
+	return message
+
+def _generate_media_message(rng, timestamp_ms, sender_name, others):
+	"""A message with attachments and reactions, shaped like the ones in facebook's exports"""
+	message = {'sender_name': sender_name, 'timestamp_ms': timestamp_ms, 'type': 'Generic'}
+	creation_timestamp = timestamp_ms // 1000
+	kind = rng.random()
+	if kind < 0.4:
+		message['photos'] = [{'uri': 'messages/inbox/photos/{}.jpg'.format(rng.randint(0, 10 ** 9)), 'creation_timestamp': creation_timestamp}
+			for _ in range(rng.randint(1, 10))]
+	elif kind < 0.5:
+		message['videos'] = [{'uri': 'messages/inbox/videos/{}.mp4'.format(rng.randint(0, 10 ** 9)), 'creation_timestamp': creation_timestamp,
+			'thumbnail': {'uri': 'messages/inbox/videos/thumbnails/{}.jpg'.format(rng.randint(0, 10 ** 9))}}]
+	elif kind < 0.6:
+		message['gifs'] = [{'uri': 'messages/inbox/gifs/{}.gif'.format(rng.randint(0, 10 ** 9))}]
+	elif kind < 0.7:
+		message['sticker'] = {'uri': 'messages/stickers_used/{}.png'.format(rng.randint(0, 10 ** 9))}
+	elif kind < 0.8:
+		message['audio_files'] = [{'uri': 'messages/inbox/audio/{}.mp4'.format(rng.randint(0, 10 ** 9)), 'creation_timestamp': creation_timestamp}]
+	else:
+		message['share'] = {'link': rng.choice(SHARE_DOMAINS) + str(rng.randint(0, 10 ** 6)), 'share_text': ' '.join(rng.sample(WORDS, 5))}
+		message['content'] = message['share']['link']
+
+	message['reactions'] = [{'reaction': '\u00f0\u009f\u0098\u0086', 'actor': rng.choice(others)} for _ in range(rng.randint(0, 6))]
+	return message
+
+###########################################################################
+# The classes analyze-messages.py used before the MessageStore, kept as the baseline
+# Every message becomes an object, the summary walks them twice and the history re-walks each month per map
+
+class LegacyMessage(object):
+	def __init__(self, **kwargs):
+		self.time = datetime.fromtimestamp(kwargs['timestamp_ms']/1000)
+		self.sender = kwargs['sender_name']
+		self.content = kwargs.get('content', '')
+		self.call_duration = kwargs.get('call_duration', -1)
+		for k in kwargs:
+			setattr(self, k, kwargs[k])
+
+	def sent_by_me(self):
+		return self.sender_name == my_name
+
+	def year_month(self):
+		return self.time.strftime('%Y-%m')
+
+	def is_call(self):
+		return self.call_duration > -1
+
+	def words_in_message(self, include_call, call_speak_rate):
+		call_words = 0
+		if include_call:
+			call_words = call_speak_rate * self.call_duration
+		return call_words if self.is_call() else len(self.content.split())
+
+	def imgur_links_in_message(self):
+		return 1 if ('imgur' in getattr(self, 'share', {'link':''}).get('link', '')) or ('imgur.com' in self.content) else 0
+
+class LegacySummary(object):
+	def __init__(self, messages, analyze):
+		self.other_person = ''
+		for message in messages:
+			if not message.sent_by_me():
+				self.other_person = message.sender_name
+				break
+
+		self.total_messages = len(messages)
+		self.my_total_messages = 0
+		self.my_actual_messages = 0
+		self.other_messages = 0
+		self.imgur_links = 0
+		self.num_words = 0
+		self.num_calls = 0
+		for message in messages:
+			if message.sent_by_me():
+				self.my_total_messages += 1
+				num_links = message.imgur_links_in_message()
+				self.imgur_links += num_links
+				if num_links == 0:
+					self.my_actual_messages += 1
+			else:
+				self.other_messages += 1
+			self.num_words += message.words_in_message(analyze.include_call_words, analyze.call_speak_rate)
+			if message.is_call() and message.call_duration > analyze.min_call_duration_length:
+				self.num_calls += 1
+
+class LegacyHistory(object):
+	def __init__(self, messages, analyze):
+		self.analyze = analyze
+		self.monthly_messages = {}
+		for message in messages:
+			self.monthly_messages.setdefault(message.year_month(), []).append(message)
+		self.message_dates = sorted(self.monthly_messages.keys())
+
+	def messages_month_map(self):
+		return {month: len(self.monthly_messages[month]) for month in self.message_dates}
+
+	def words_month_map(self):
+		return {month: sum(message.words_in_message(self.analyze.include_call_words, self.analyze.call_speak_rate) for message in self.monthly_messages[month])
+			for month in self.message_dates}
+
+# anonymize.py's recursive scrubbing before the recursion depth was bounded, kept as the baseline
+def legacy_anonymize_uris_actors(msg_dict):
+	for key in msg_dict.keys():
+		
+		if key in ['uri', 'actor']:
+			msg_dict[key] = ''
+		else:
+			attr = msg_dict[key]
+			if type(attr) is list:
+				for i in range(len(attr)):
+					if type(attr[i]) is dict:
+						legacy_anonymize_uris_actors(attr[i])
+					else:
+						attr[i] = ''
+					
+			elif type(attr) is dict:
+				legacy_anonymize_uris_actors(attr)
+
+###########################################################################
+# Benchmarks
+
+SUMMARY_COUNTERS = ['other_person', 'total_messages', 'my_total_messages', 'my_actual_messages', 'other_messages', 'imgur_links', 'num_words', 'num_calls']
+# The counters that got another name since the legacy classes
+RENAMED_COUNTERS = {'imgur_links': 'num_links'}
+
+def bench_fused(args):
+	"""
+	Times building the summary and the message/word month maps of each example conversation, scaled up `--scale` times,
+	with the legacy classes and with the MessageStore.  Checks that both give the same numbers
+	"""
+	analyze = load_analyze_messages()
+
+	def legacy(messages):
+		message_objs = [LegacyMessage(**message) for message in messages]
+		summary = LegacySummary(message_objs, analyze)
+		history = LegacyHistory(message_objs, analyze)
+		return summary, history.messages_month_map(), history.words_month_map()
+
+	def fused(messages):
+		store = analyze.MessageStore()
+		store.add_messages(messages, None)
+		summary = analyze.ConversationSummary(store)
+		history = analyze.ConversationHistory(store)
+		return summary, history.messages_month_map(), history.words_month_map()
+
+	print('{:<16} {:>10} {:>12} {:>12} {:>8}'.format('conversation', 'messages', 'legacy (s)', 'fused (s)', 'speedup'))
+	total_legacy = total_fused = 0
+	for name in sorted(os.listdir(args.path)):
+		folder = os.path.join(args.path, name)
+		if not os.path.isdir(folder):
+			continue
+		messages = scale_messages(read_messages(folder), args.scale)
+
+		legacy_time, (legacy_summary, legacy_messages, legacy_words) = best_time(lambda: legacy(messages), args.repeat)
+		fused_time, (fused_summary, fused_messages, fused_words) = best_time(lambda: fused(messages), args.repeat)
+
+		for counter in SUMMARY_COUNTERS:
+			assert getattr(legacy_summary, counter) == getattr(fused_summary, RENAMED_COUNTERS.get(counter, counter)), 'Summary {} differs for {}'.format(counter, name)
+		assert legacy_messages == fused_messages and legacy_words == fused_words, 'Month maps differ for {}'.format(name)
+
+		total_legacy += legacy_time
+		total_fused += fused_time
+		print('{:<16} {:>10} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(name, len(messages), legacy_time, fused_time, legacy_time / fused_time))
+
+	print('{:<16} {:>10} {:>12.3f} {:>12.3f} {:>7.1f}x'.format('total', '', total_legacy, total_fused, total_legacy / total_fused))
+
+def bench_scrub(args):
+	"""
+	Times blanking the uris and actors of `--messages` media-heavy messages with the old recursive function and with anonymize.py's
+	Checks that both give the same messages, and that a payload nested past the recursion limit can be scrubbed
+	"""
+	import anonymize
+
+	rng = random.Random(args.seed)
+	others = ['Person {}'.format(idx) for idx in range(5)] + [my_name]
+	timestamp_ms = 1577836800000
+	messages = []
+	for _ in range(args.messages):
+		timestamp_ms -= rng.randint(1000, 3600000)
+		messages.append(_generate_media_message(rng, timestamp_ms, rng.choice(others), others))
+
+	def run(scrub):
+		# The copy is made outside the timing
+		copies = copy.deepcopy(messages)
+		start = time.perf_counter()
+		for message in copies:
+			scrub(message)
+		return time.perf_counter() - start, copies
+
+	# The runs of both scrubbers take turns, so a slow spell of the machine doesn't land on one of them only. The best of each is kept
+	legacy_time = scrub_time = float('inf')
+	for _ in range(args.repeat):
+		(elapsed, legacy_messages) = run(legacy_anonymize_uris_actors)
+		legacy_time = min(legacy_time, elapsed)
+		(elapsed, scrub_messages) = run(anonymize.anonymize_uris_actors)
+		scrub_time = min(scrub_time, elapsed)
+	assert legacy_messages == scrub_messages, 'Scrubbed messages differ'
+
+	print('{:<10} {:>10} {:>14}'.format('scrubber', 'time (s)', 'messages/s'))
+	print('{:<10} {:>10.3f} {:>14.0f}'.format('legacy', legacy_time, len(messages) / legacy_time))
+	print('{:<10} {:>10.3f} {:>14.0f}'.format('anonymize', scrub_time, len(messages) / scrub_time))
+	print('speedup {:.2f}x'.format(legacy_time / scrub_time))
+
+	innermost = {'uri': 'messages/deep'}
+	deep = innermost
+	for _ in range(sys.getrecursionlimit()):
+		deep = {'share': [deep]}
+	anonymize.anonymize_uris_actors(deep)
+	assert innermost['uri'] == '', 'Deeply nested uri was not scrubbed'
+	print('Scrubbed a payload nested {} levels deep'.format(sys.getrecursionlimit() * 2))
+
+def bench_read(args):
+	"""
+	Times filling a MessageStore for every two-person conversation with the files streamed one message at a time and with
+	each file decoded in one go, along with the peak RSS of each.  Checks that both give the same columns and totals
+	If no --path is given, a synthetic inbox is generated in a temporary directory first
+	"""
+	analyze = load_analyze_messages()
+	with benchmark_inbox(args) as (inbox, _):
+		results = []
+		for (name, whole_file_size) in [('streamed', 0), ('whole', WHOLE_FILE_SIZE)]:
+			best = None
+			for _ in range(args.repeat):
+				with PeakRSS() as rss:
+					start = time.perf_counter()
+					stores = load_stores(analyze, inbox, whole_file_size)
+					elapsed = time.perf_counter() - start
+				best = elapsed if best is None else min(best, elapsed)
+			results.append((name, best, rss.peak, stores))
+
+	(streamed_stores, whole_stores) = (results[0][3], results[1][3])
+	for (streamed, whole) in zip(streamed_stores, whole_stores):
+		for column in analyze.MessageStore.COLUMNS:
+			assert getattr(streamed, column) == getattr(whole, column), 'Column {} differs'.format(column)
+		assert streamed.totals == whole.totals and streamed.other_person == whole.other_person, 'Totals differ'
+
+	num_messages = sum(len(store) for store in streamed_stores)
+	print('{:<10} {:>10} {:>14} {:>14}'.format('reader', 'time (s)', 'messages/s', 'peak RSS (MB)'))
+	for (name, elapsed, peak, _) in results:
+		print('{:<10} {:>10.3f} {:>14.0f} {:>14.1f}'.format(name, elapsed, num_messages / elapsed, peak / 1e6))
+	print('speedup {:.2f}x'.format(results[0][1] / results[1][1]))
+
+def bench_startup(args):
+	"""
+	Times whole runs of analyze-messages.py on a small inbox, where the run is mostly the startup, for the text-only paths and for one that
+	builds graphs.  Checks with `python -X importtime` that the text-only paths never import plotly, and times importing plotly on its own
+	"""
+	script = script_path('analyze-messages.py')
+	tmp_dir = tempfile.mkdtemp(prefix='messenger-benchmark-')
+	try:
+		runs = [
+			('summary', ['-so'], False),
+			('starts', ['-so', '-st', '24,168'], False),
+			('graphs', ['-rd', os.path.join(tmp_dir, 'graphs'), '-rf', 'json'], True),
+		]
+		def median_time(command):
+			times = []
+			for _ in range(args.repeat):
+				start = time.perf_counter()
+				subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+				times.append(time.perf_counter() - start)
+			return sorted(times)[len(times) // 2]
+
+		print('{:<16} {:>10} {:>16}'.format('run', 'time (s)', 'imports plotly'))
+		for (name, run_args, builds_graphs) in runs:
+			command = [sys.executable, script, my_name, '-p', args.path, '-nc'] + run_args
+			imports = subprocess.run([sys.executable, '-X', 'importtime'] + command[1:], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+				universal_newlines=True).stderr
+			imports_plotly = any(line.split('|')[-1].strip().split('.')[0] == 'plotly' for line in imports.splitlines())
+			assert imports_plotly == builds_graphs, 'The {} run {} plotly'.format(name, 'imports' if imports_plotly else 'does not import')
+			print('{:<16} {:>10.3f} {:>16}'.format(name, median_time(command), 'yes' if imports_plotly else 'no'))
+
+		python_time = median_time([sys.executable, '-c', 'pass'])
+		plotly_time = median_time([sys.executable, '-c', 'import plotly.graph_objects'])
+		print('{:<16} {:>10.3f}'.format('import plotly', plotly_time - python_time))
+	finally:
+		shutil.rmtree(tmp_dir)
+
+def bench_serve(args):
+	"""
+	Starts analyze-messages.py --serve on an inbox and times each query the first time, when it is computed, and repeated, when it comes
+	from the response cache, over one kept-alive connection.  Also times a one-off --summary-only run for comparison
+	If no --path is given, a synthetic inbox is generated in a temporary directory first
+	"""
+	script = script_path('analyze-messages.py')
+	queries = ['/sorts', '/summaries', '/summaries?sort=num_words&top=50', '/summaries?since=2015&until=2016', '/history?top=5',
+		'/history?granularity=week&top=5', '/starts?hours=24,72,168']
+	with benchmark_inbox(args) as (inbox, tmp_dir):
+		command = [sys.executable, script, my_name, '-p', inbox, '-cd', os.path.join(tmp_dir, 'cache')]
+
+		start = time.perf_counter()
+		subprocess.run(command + ['-so'], check=True, stdout=subprocess.DEVNULL)
+		cli_time = time.perf_counter() - start
+
+		with socket.socket() as free:
+			free.bind(('localhost', 0))
+			port = free.getsockname()[1]
+		start = time.perf_counter()
+		process = subprocess.Popen(command + ['-sv', 'localhost:{}'.format(port)], stdout=subprocess.DEVNULL)
+		try:
+			connection = http.client.HTTPConnection('localhost', port)
+			while True:
+				try:
+					connection.request('GET', '/')
+					connection.getresponse().read()
+					break
+				except ConnectionError:
+					assert process.poll() is None, 'The server exited'
+					connection.close()
+					time.sleep(0.05)
+			ready_time = time.perf_counter() - start
+
+			def timed_query(query):
+				start = time.perf_counter()
+				connection.request('GET', query)
+				response = connection.getresponse()
+				response.read()
+				assert response.status == 200, '{} answered {}'.format(query, response.status)
+				return (time.perf_counter() - start, response.getheader('X-Cache'))
+
+			print('{:<40} {:>12} {:>12}'.format('query', 'first (ms)', 'cached (ms)'))
+			for query in queries:
+				(first, first_cache) = timed_query(query)
+				repeats = [timed_query(query) for _ in range(args.repeat)]
+				assert first_cache == 'miss' and all(cache == 'hit' for (_, cache) in repeats), '{} was not cached'.format(query)
+				print('{:<40} {:>12.2f} {:>12.2f}'.format(query, first * 1000, sorted(elapsed for (elapsed, _) in repeats)[args.repeat // 2] * 1000))
+			connection.close()
+		finally:
+			process.terminate()
+			process.wait()
+		print('--summary-only run {:.2f}s, server ready after {:.2f}s'.format(cli_time, ready_time))
+
+def bench_sketches(args):
+	"""
+	Feeds the vocabulary sketches files of words drawn from a Zipf distribution, like real text, and compares them with exact counts:
+	the distinct words, the most used words and their bounds, the time, and the memory of the sketches against a Counter of every word
+	The bundled and generated inboxes only use a few dozen words, which the sketches count exactly
+	"""
+	rng = random.Random(args.seed)
+	vocabulary = ['w{}'.format(idx) for idx in range(args.vocabulary)]
+	weights = [1 / (idx + 1) for idx in range(args.vocabulary)]
+	files = [collections.Counter(rng.choices(vocabulary, weights, k=args.words_per_file)) for _ in range(args.files)]
+
+	start = time.perf_counter()
+	sketch = WordSketch()
+	for file_counts in files:
+		sketch.add_counts(file_counts)
+	sketch_time = time.perf_counter() - start
+
+	start = time.perf_counter()
+	exact = collections.Counter()
+	for file_counts in files:
+		exact.update(file_counts)
+	exact_time = time.perf_counter() - start
+
+	distinct = sketch.distinct.estimate()
+	print('{} words, {} distinct, {} files'.format(sum(exact.values()), len(exact), args.files))
+	print('distinct words ~{}, off by {:.2%} with a standard error of {:.2%}'.format(distinct, distinct / len(exact) - 1, sketch.distinct.relative_error()))
+
+	top = sketch.top(args.top)
+	exact_top = [word for (word, _) in exact.most_common(args.top)]
+	print('{:<8} {:>10} {:>10} {:>10}'.format('word', 'exact', 'low', 'high'))
+	for (word, low, high) in top:
+		assert low <= exact[word] <= high, 'The count of {} is out of its bounds'.format(word)
+		print('{:<8} {:>10} {:>10} {:>10}'.format(word, exact[word], low, high))
+	print('{} of the top {} words are the exact ones'.format(len(set(exact_top) & {word for (word, _, _) in top}), args.top))
+
+	cms_errors = sketch.counts.estimate_hashes(hash_words(list(exact))).astype(np.int64) - np.array(list(exact.values()))
+	print('count-min over by {:.1f} on average and {} at most, bound {:.0f} with {:.0%} probability, {:.2%} of words over it'.format(
+		cms_errors.mean(), cms_errors.max(), sketch.counts.error(), sketch.counts.confidence(), np.mean(cms_errors > sketch.counts.error())))
+
+	sketch_bytes = sketch.distinct.registers.nbytes + sketch.counts.table.nbytes + len(pickle.dumps((sketch.top_words.counts, sketch.top_words.errors)))
+	print('{:<10} {:>10} {:>12}'.format('', 'time (s)', 'memory (KB)'))
+	print('{:<10} {:>10.3f} {:>12.1f}'.format('sketches', sketch_time, sketch_bytes / 1e3))
+	print('{:<10} {:>10.3f} {:>12.1f}'.format('counter', exact_time, len(pickle.dumps(exact)) / 1e3))
+
+# Shared links and whether they count for --link-domains www.youtube.com,open.spotify.com,imgur.com
+LINK_DOMAINS = ['www.youtube.com', 'open.spotify.com', 'imgur.com']
+SHARED_LINKS = [
+	('https://www.youtube.com/watch?v=dQw4w9WgXcQ', True),
+	('https://open.spotify.com/track/4uLU6hMCjMI75M1A2tKUQC', True),
+	('https://imgur.com/gallery/abc', True),
+	('https://i.imgur.com/abc.jpg', True),
+	('HTTPS://I.IMGUR.COM/abc.jpg', True),
+	('imgur.com/abc', True),
+	('https://www.reddit.com/r/pics', False),
+	('https://www.opentable.com/r/some-restaurant', False),
+	('https://open.spotify.com.example.com/track/1', False),
+	('https://notimgur.com/abc', False),
+	('https://youtube.com/watch?v=dQw4w9WgXcQ', False),
+	# A domain of its own, which has to be listed to count
+	('https://youtu.be/dQw4w9WgXcQ', False),
+	('', False),
+]
+
+def bench_links(args):
+	"""
+	Checks which shared links count as links for --link-domains, then times counting the links of `--messages` shares
+	"""
+	analyze = load_analyze_messages()
+	(match_share, _) = analyze.link_matchers(tuple(LINK_DOMAINS))
+	for (link, counts) in SHARED_LINKS:
+		assert bool(match_share(link)) == counts, '{!r} should {}count as a link'.format(link, '' if counts else 'not ')
+	(match_share, _) = analyze.link_matchers(tuple(LINK_DOMAINS + ['youtu.be']))
+	assert match_share('https://youtu.be/dQw4w9WgXcQ'), 'youtu.be should count once it is listed'
+	print('{} shared links counted as expected for {}'.format(len(SHARED_LINKS), ','.join(LINK_DOMAINS)))
+
+	rng = random.Random(args.seed)
+	links = [(IMGUR_LINK if rng.random() < imgur_fraction else rng.choice(SHARE_DOMAINS)) + str(rng.randint(0, 10 ** 6)) for _ in range(args.messages)]
+	elapsed, num_links = best_time(lambda: sum(1 for link in links if match_share(link)), args.repeat)
+	print('{} of {} shares are links, {:.0f} shares/s'.format(num_links, len(links), len(links) / elapsed))
+
+def bench_generate(args):
+	start = time.perf_counter()
+	total = generate_inbox(args.out_dir, args.conversations, args.messages, args.per_file, args.groups, args.calls, args.shares, args.imgur, args.photos, args.seed)
+	print('Wrote {} messages in {} conversations to {} in {:.1f}s'.format(total, args.conversations, args.out_dir, time.perf_counter() - start))
+
+def bench_stages(args):
+	"""
+	Times each stage of an analysis run on its own: streaming the files into MessageStores, the summaries, the histories with their month maps,
+	sorting by every sort mode and running anonymize.py over the whole inbox
+	If no --path is given, a synthetic inbox is generated in a temporary directory first
+	"""
+	analyze = load_analyze_messages()
+	with benchmark_inbox(args) as (inbox, tmp_dir):
+		# Raw bytes are only needed for the throughput of the loading stage
+		json_files = [os.path.join(inbox, name, file_name) for name in sorted(os.listdir(inbox)) for file_name in sorted(os.listdir(os.path.join(inbox, name)))
+			if '.json' in file_name]
+		num_bytes = sum(os.path.getsize(file_path) for file_path in json_files)
+
+		results = []
+		def stage(name, func):
+			with PeakRSS() as rss:
+				start = time.perf_counter()
+				result = func()
+				elapsed = time.perf_counter() - start
+			results.append((name, elapsed, rss.peak))
+			return result
+
+		stores = stage('load', lambda: load_stores(analyze, inbox))
+		num_messages = sum(len(store) for store in stores)
+
+		summaries = stage('summary', lambda: [analyze.ConversationSummary(store) for store in stores])
+
+		def history():
+			histories = []
+			for store in stores:
+				conversation_history = analyze.ConversationHistory(store)
+				conversation_history.messages_month_map()
+				conversation_history.words_month_map()
+				conversation_history.call_duration_month_map()
+				histories.append(conversation_history)
+			return histories
+		histories = stage('history', history)
+
+		conversations = [analyze.Conversation(store, summary=summary, history=conversation_history)
+			for (store, summary, conversation_history) in zip(stores, summaries, histories)]
+		stage('sort', lambda: [analyze.sort_conversations(conversations, sort_mode) for sort_mode in analyze.SORT_CONFIGS])
+
+		if not args.skip_anonymize:
+			script = script_path('anonymize.py')
+			out_dir = os.path.join(tmp_dir, 'anonymized')
+			def anonymize():
+				subprocess.run([sys.executable, script, '--inbox', inbox, out_dir, my_name], check=True, stdout=subprocess.DEVNULL)
+			stage('anonymize', anonymize)
+
+	print('{} json files, {:.1f} MB, {} messages in two-person conversations'.format(len(json_files), num_bytes / 1e6, num_messages))
+	# Every stage handles all of the messages, so throughput is always measured against the total
+	print('{:<10} {:>10} {:>14} {:>14}'.format('stage', 'time (s)', 'messages/s', 'peak RSS (MB)'))
+	for (name, elapsed, peak) in results:
+		print('{:<10} {:>10.3f} {:>14.0f} {:>14.1f}'.format(name, elapsed, num_messages / elapsed if elapsed else 0, peak / 1e6))
+
+def _add_generator_arguments(parser):
+	parser.add_argument('-n', '--conversations', type=int, default=num_conversations,
+		help='Number of conversations. Default {}'.format(num_conversations))
+	parser.add_argument('-m', '--messages', type=int, default=messages_per_conversation,
+		help='Average number of messages per conversation. Default {}'.format(messages_per_conversation))
+	parser.add_argument('--per-file', type=int, default=messages_per_file,
+		help='Messages per message_N.json file. Default {}'.format(messages_per_file))
+	parser.add_argument('--groups', type=float, default=group_fraction,
+		help='Fraction of conversations that are group chats. Default {}'.format(group_fraction))
+	parser.add_argument('--calls', type=float, default=call_fraction,
+		help='Fraction of messages that are calls. Default {}'.format(call_fraction))
+	parser.add_argument('--shares', type=float, default=share_fraction,
+		help='Fraction of messages that are shared links. Default {}'.format(share_fraction))
+	parser.add_argument('--imgur', type=float, default=imgur_fraction,
+		help='Fraction of shared links that are imgur links. Default {}'.format(imgur_fraction))
+	parser.add_argument('--photos', type=float, default=photo_fraction,
+		help='Fraction of messages that are photos. Default {}'.format(photo_fraction))
+	parser.add_argument('--seed', type=int, default=0,
+		help='Seed of the random generator, the same seed gives the same inbox. Default 0')
+
+###########################################################################
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description='Benchmarks for analyze-messages.py')
+	subparsers = parser.add_subparsers(dest='benchmark')
+	subparsers.required = True
+
+	generate_parser = subparsers.add_parser('generate', help='Write a synthetic inbox that looks like a facebook messenger export')
+	generate_parser.add_argument('out_dir', type=str,
+		help='Directory to write the conversation folders to')
+	_add_generator_arguments(generate_parser)
+	generate_parser.set_defaults(func=bench_generate)
+
+	stages_parser = subparsers.add_parser('stages', help='Time loading, summary, history, sort and anonymize stages on an inbox')
+	stages_parser.add_argument('-p', '--path', type=str, default='',
+		help='Inbox to benchmark. If not given, a synthetic inbox is generated with the options below')
+	stages_parser.add_argument('--skip-anonymize', action='store_true',
+		help='Do not time anonymize.py')
+	_add_generator_arguments(stages_parser)
+	stages_parser.set_defaults(func=bench_stages)
+
+	read_parser = subparsers.add_parser('read', help='Streaming the json files one message at a time against decoding each file in one go')
+	read_parser.add_argument('-p', '--path', type=str, default='',
+		help='Inbox to benchmark. If not given, a synthetic inbox is generated with the options below')
+	read_parser.add_argument('--repeat', type=int, default=3,
+		help='Runs per reader, the best time is kept. Default 3')
+	_add_generator_arguments(read_parser)
+	read_parser.set_defaults(func=bench_read)
+
+	startup_parser = subparsers.add_parser('startup', help='Whole runs on a small inbox, checking that the text-only ones never import plotly')
+	startup_parser.add_argument('-p', '--path', type=str, default=path,
+		help='Inbox to run on. Default "./inbox"')
+	startup_parser.add_argument('--repeat', type=int, default=5,
+		help='Runs per command, the median time is reported. Default 5')
+	startup_parser.set_defaults(func=bench_startup)
+
+	serve_parser = subparsers.add_parser('serve', help='Latency of the --serve queries, computed and from the response cache, against a --summary-only run')
+	serve_parser.add_argument('-p', '--path', type=str, default='',
+		help='Inbox to serve. If not given, a synthetic inbox is generated with the options below')
+	serve_parser.add_argument('--repeat', type=int, default=20,
+		help='Cached repeats per query, the median time is reported. Default 20')
+	_add_generator_arguments(serve_parser)
+	serve_parser.set_defaults(func=bench_serve)
+
+	sketches_parser = subparsers.add_parser('sketches', help='The vocabulary sketches against exact counts on Zipf distributed words')
+	sketches_parser.add_argument('--vocabulary', type=int, default=200000,
+		help='Number of different words to draw from. Default 200000')
+	sketches_parser.add_argument('--files', type=int, default=50,
+		help='Number of files the words are fed in. Default 50')
+	sketches_parser.add_argument('--words-per-file', type=int, default=50000,
+		help='Words in each file. Default 50000')
+	sketches_parser.add_argument('--top', type=int, default=10,
+		help='Number of most used words to compare. Default 10')
+	sketches_parser.add_argument('--seed', type=int, default=0,
+		help='Random seed. Default 0')
+	sketches_parser.set_defaults(func=bench_sketches)
+
+	fused_parser = subparsers.add_parser('fused', help='Single-pass MessageStore against the old per-message classes')
+	fused_parser.add_argument('-p', '--path', type=str, default=path,
+		help='Inbox with the conversations to scale up. Default "./inbox"')
+	fused_parser.add_argument('--scale', type=int, default=20,
+		help='How many times to repeat each conversation. Default 20')
+	fused_parser.add_argument('--repeat', type=int, default=3,
+		help='Runs per timing, the best one is reported. Default 3')
+	fused_parser.set_defaults(func=bench_fused)
+
+	links_parser = subparsers.add_parser('links', help='Which shared links count for --link-domains, and how fast they are counted')
+	links_parser.add_argument('-m', '--messages', type=int, default=100000,
+		help='Number of shares to time. Default 100000')
+	links_parser.add_argument('--repeat', type=int, default=3,
+		help='Runs, the best time is kept. Default 3')
+	links_parser.add_argument('--seed', type=int, default=0,
+		help='Random seed. Default 0')
+	links_parser.set_defaults(func=bench_links)
+
+	scrub_parser = subparsers.add_parser('scrub', help="anonymize.py's uri/actor scrubbing against the old recursive function on media-heavy messages")
+	scrub_parser.add_argument('-m', '--messages', type=int, default=100000,
+		help='Number of messages. Default 100000')
+	scrub_parser.add_argument('--repeat', type=int, default=3,
+		help='Runs per scrubber, the best time is kept. Default 3')
+	scrub_parser.add_argument('--seed', type=int, default=0,
+		help='Random seed. Default 0')
+	scrub_parser.set_defaults(func=bench_scrub)
+
+	args = parser.parse_args()
+	args.func(args)
@@ -0,0 +1,68 @@
+"""
+The plotly side of analyze-messages.py: the traces and styled figures of the graphs, and turning figures into html or json
+
+Importing plotly takes a large part of a second, so analyze-messages.py only imports this module once a figure is built.
+Runs that only print, like `--summary-only`, never import plotly
+"""
+
+import plotly.graph_objects as go
+import plotly.io as pio
+from plotly.offline import get_plotlyjs
+
+###########################################################################
+
+def history_bar(name, dates, values):
+	return go.Bar(name=name, x=dates, y=values)
+
+def history_relative_line(name, dates, values):
+	return go.Scatter(name=name, x=dates, y=values, mode='lines', stackgroup='one', groupnorm='percent')
+
+def bar_figure(traces, name, y_axis_title, bar_mode='group'):
+	figure = go.Figure(data=traces)
+	figure.update_layout(
+		barmode=bar_mode,
+		title=go.layout.Title(
+			text=name,
+			xref='paper',
+			x=0
+		),
+		xaxis=go.layout.XAxis(
+			nticks=50,
+			tickangle=-45
+		),
+		yaxis=go.layout.YAxis(
+		title=go.layout.yaxis.Title(text=y_axis_title)
+		)
+	)
+	return figure
+
+def relative_percent_figure(traces, name):
+	figure = go.Figure()
+	for trace in traces:
+		figure.add_trace(trace)
+	figure.update_layout(
+		showlegend=True,
+		title=go.layout.Title(
+			text=name,
+			xref='paper',
+			x=0
+		),
+		yaxis=dict(
+			type='linear',
+			range=[1, 100],
+			ticksuffix='%'
+		)
+	)
+	return figure
+
+def plotly_js():
+	"""The plotly.js bundle the html pages load"""
+	return get_plotlyjs()
+
+def figure_html(figure):
+	"""An html page for a figure dict, which loads plotly.js from a file next to it"""
+	# The figure was already validated when it was built
+	return pio.to_html(figure, include_plotlyjs='directory', validate=False)
+
+def figure_json(figure):
+	return pio.to_json(figure, validate=False)
@@ -0,0 +1,162 @@
+"""
+Incremental reader for facebook messenger `message_N.json` files
+
+Reads the file in chunks and decodes one message at a time, so a whole conversation is never in memory at once.
+Everything before the `messages` array (`participants` in facebook's exports) is decoded up front into `header`,
+so a file can be checked and skipped before any messages are read.
+"""
+
+import json
+import os
+
+###########################################################################
+# Constants
+
+CHUNK_SIZE = 1 << 20
+
+# The header is usually tiny, so the first read is kept small in case the file gets skipped after it
+HEADER_CHUNK_SIZE = 1 << 14
+
+# A `whole_file_size` that covers every file of a normal export.  Facebook splits conversations into files of 10000 messages,
+# which are a few MB
+WHOLE_FILE_SIZE = 32 << 20
+
+WHITESPACE = ' \t\n\r'
+
+MESSAGES_KEY = 'messages'
+
+###########################################################################
+
+class MessageFileReader(object):
+	"""
+	Iterating the reader yields the message dicts in file order
+	Keys that come after the `messages` array are added to `header` once the iteration is done
+	If a file does not have `participants` before `messages`, the whole file is decoded the usual way instead
+	Files up to `whole_file_size` bytes are decoded in one go too, once the messages are iterated.  The json module decodes a whole
+	file faster than it can be stepped through one message at a time, but then the whole file is in memory.  0 always streams
+	"""
+	def __init__(self, file_path, chunk_size=CHUNK_SIZE, whole_file_size=0):
+		self.file_path = file_path
+		self.chunk_size = chunk_size
+		self.whole_file_size = whole_file_size
+		self.header = {}
+
+		self._file = open(file_path)
+		self._decoder = json.JSONDecoder()
+		self._buffer = ''
+		self._pos = 0
+		self._eof = False
+		# Set when the file has to be decoded in one go
+		self._messages = None
+
+		self._read_header()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def close(self):
+		self._file.close()
+
+	def __iter__(self):
+		if self._at_messages and os.fstat(self._file.fileno()).st_size <= self.whole_file_size:
+			self._decode_whole_file()
+		if self._messages is not None:
+			messages, self._messages = self._messages, []
+			yield from messages
+			return
+
+		if not self._at_messages:
+			return
+		self._at_messages = False
+
+		self._expect('[')
+		if self._peek() == ']':
+			self._pos += 1
+		else:
+			while True:
+				yield self._decode_value()
+				if self._expect(',]') == ']':
+					break
+
+		# Keys after the messages array
+		if self._expect(',}') == ',':
+			self._read_members()
+
+	def _read_header(self):
+		self._at_messages = False
+		chunk_size, self.chunk_size = self.chunk_size, min(self.chunk_size, HEADER_CHUNK_SIZE)
+		try:
+			self._expect('{')
+			if self._peek() == '}':
+				return
+			self._read_members()
+		finally:
+			self.chunk_size = chunk_size
+
+		if self._at_messages and 'participants' not in self.header:
+			self._decode_whole_file()
+
+	def _read_members(self):
+		"""Reads `"key": value` pairs into the header until the end of the object or the messages key"""
+		while True:
+			key = self._decode_value()
+			self._expect(':')
+			if key == MESSAGES_KEY:
+				self._at_messages = True
+				return
+			self.header[key] = self._decode_value()
+			if self._expect(',}') == '}':
+				return
+
+	def _decode_whole_file(self):
+		self._file.seek(0)
+		data = json.load(self._file)
+		self._messages = data.pop(MESSAGES_KEY, [])
+		self.header = data
+		self._at_messages = False
+
+	def _fill(self):
+		"""Reads another chunk into the buffer, dropping what was already consumed.  Returns False at the end of the file"""
+		if self._eof:
+			return False
+		chunk = self._file.read(self.chunk_size)
+		if not chunk:
+			self._eof = True
+			return False
+		self._buffer = self._buffer[self._pos:] + chunk
+		self._pos = 0
+		return True
+
+	def _peek(self):
+		"""Returns the next non-whitespace character without consuming it"""
+		while True:
+			while self._pos < len(self._buffer) and self._buffer[self._pos] in WHITESPACE:
+				self._pos += 1
+			if self._pos < len(self._buffer):
+				return self._buffer[self._pos]
+			if not self._fill():
+				raise ValueError('Unexpected end of file in {}'.format(self.file_path))
+
+	def _expect(self, chars):
+		char = self._peek()
+		if char not in chars:
+			raise ValueError('Expected one of {!r} but found {!r} in {}'.format(chars, char, self.file_path))
+		self._pos += 1
+		return char
+
+	def _decode_value(self):
+		self._peek()
+		while True:
+			try:
+				value, end = self._decoder.raw_decode(self._buffer, self._pos)
+				# A number at the very end of the buffer might continue in the next chunk
+				if end < len(self._buffer) or self._eof:
+					self._pos = end
+					return value
+			except json.JSONDecodeError:
+				if self._eof:
+					raise
+			self._fill()
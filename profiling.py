@@ -0,0 +1,127 @@
+"""
+Per-stage and per-conversation timing of an analyze-messages.py run, for `--profile`
+
+The stages are timed in the main process.  The conversations are timed where they are loaded, which can be a worker process.
+`Profiler.write_trace` writes the Trace Event Format that chrome://tracing and https://ui.perfetto.dev open
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+import psutil
+
+###########################################################################
+# Constants
+
+# How many of the slowest conversations the table shows
+SLOWEST_CONVERSATIONS = 10
+
+###########################################################################
+
+class PeakRSS(object):
+	"""
+	Context manager that samples the resident set size of this process in a background thread
+	`peak` is the highest RSS in bytes seen while it was active
+	"""
+	def __init__(self, interval=0.01):
+		self.interval = interval
+		self.peak = 0
+		self._process = psutil.Process()
+		self._done = threading.Event()
+
+	def __enter__(self):
+		self.peak = self._process.memory_info().rss
+		self._thread = threading.Thread(target=self._sample, daemon=True)
+		self._thread.start()
+		return self
+
+	def __exit__(self, *exc):
+		self._done.set()
+		self._thread.join()
+		self.peak = max(self.peak, self._process.memory_info().rss)
+
+	def _sample(self):
+		while not self._done.wait(self.interval):
+			self.peak = max(self.peak, self._process.memory_info().rss)
+
+def cpu_time():
+	"""CPU seconds of this process and of the child processes that have finished, like the workers of a closed process pool"""
+	times = os.times()
+	return times.user + times.system + times.children_user + times.children_system
+
+class Profiler(object):
+	"""
+	Collects a record per stage and per conversation.  A disabled profiler records nothing, so the run doesn't need to check
+	"""
+	def __init__(self, enabled=True):
+		self.enabled = enabled
+		self.stages = []
+		self.conversations = []
+
+	@contextmanager
+	def stage(self, name):
+		"""
+		Times the block as a stage.  The block can fill in the `bytes` and `messages` it handled on the yielded record
+		"""
+		record = {'name': name, 'bytes': 0, 'messages': 0}
+		if not self.enabled:
+			yield record
+			return
+
+		with PeakRSS() as rss:
+			start = time.perf_counter()
+			start_cpu = cpu_time()
+			try:
+				yield record
+			finally:
+				record['start'] = start
+				record['wall'] = time.perf_counter() - start
+				record['cpu'] = cpu_time() - start_cpu
+		record['peak_rss'] = rss.peak
+		self.stages.append(record)
+
+	def add_conversation(self, name, start, wall, cpu, num_bytes, messages, from_cache, pid):
+		if self.enabled:
+			self.conversations.append({'name': name, 'start': start, 'wall': wall, 'cpu': cpu, 'bytes': num_bytes, 'messages': messages,
+				'from_cache': from_cache, 'pid': pid})
+
+	def table(self):
+		lines = ['{:<12} {:>9} {:>9} {:>9} {:>12} {:>12} {:>10}'.format('stage', 'wall (s)', 'cpu (s)', 'MB', 'messages', 'messages/s', 'peak MB')]
+		for stage in self.stages:
+			lines.append('{:<12} {:>9.3f} {:>9.3f} {:>9.1f} {:>12} {:>12} {:>10.1f}'.format(stage['name'], stage['wall'], stage['cpu'], stage['bytes'] / 1e6,
+				stage['messages'] or '-', _rate(stage['messages'], stage['wall']), stage['peak_rss'] / 1e6))
+
+		if self.conversations:
+			lines.append('')
+			lines.append('{:<32} {:>9} {:>9} {:>9} {:>12} {:>12} {:>10}'.format('slowest conversations', 'wall (s)', 'cpu (s)', 'MB', 'messages', 'messages/s', 'cached'))
+			for conversation in sorted(self.conversations, key=lambda conversation: conversation['wall'], reverse=True)[:SLOWEST_CONVERSATIONS]:
+				lines.append('{:<32} {:>9.3f} {:>9.3f} {:>9.1f} {:>12} {:>12} {:>10}'.format(conversation['name'][:32], conversation['wall'], conversation['cpu'],
+					conversation['bytes'] / 1e6, conversation['messages'], _rate(conversation['messages'], conversation['wall']), 'yes' if conversation['from_cache'] else 'no'))
+		return '\n'.join(lines)
+
+	def write_trace(self, file_path):
+		"""
+		Writes every stage and conversation as a complete ('X') event, with the numbers as its args
+		Stages are on the main process' track and conversations on the track of the process that loaded them
+		"""
+		pid = os.getpid()
+		events = []
+		for stage in self.stages:
+			events.append(_trace_event(stage['name'], 'stage', stage['start'], stage['wall'], pid, {
+				'cpu_s': stage['cpu'], 'bytes': stage['bytes'], 'messages': stage['messages'], 'peak_rss_bytes': stage['peak_rss']}))
+		for conversation in self.conversations:
+			events.append(_trace_event(conversation['name'], 'conversation', conversation['start'], conversation['wall'], conversation['pid'], {
+				'cpu_s': conversation['cpu'], 'bytes': conversation['bytes'], 'messages': conversation['messages'], 'from_cache': conversation['from_cache']}))
+
+		with open(file_path, 'w') as f:
+			json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+def _rate(messages, seconds):
+	return '{:.0f}'.format(messages / seconds) if messages and seconds else '-'
+
+def _trace_event(name, category, start, duration, pid, args):
+	# perf_counter is the same clock in every process, so the events of the workers line up with the stages
+	return {'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6, 'pid': pid, 'tid': pid, 'args': args}
@@ -0,0 +1,150 @@
+"""
+Inverted index of message content, for `--search` in analyze-messages.py
+
+Every token maps to its postings: the row of each message it is in and its position in that message, sorted by row and position.
+Rows are numbered over all the indexed messages, so the caller maps them back to its conversations.  A phrase is found by shifting
+the postings of each of its tokens back by the token's place in the phrase and intersecting them.
+Saved with `np.savez_compressed`, with the rows delta-encoded first so the sorted postings compress to a fraction of their size
+"""
+
+from array import array
+import re
+
+import numpy as np
+
+from atomic_file import atomic_path
+
+###########################################################################
+# Constants
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Positions are cut off here, so a (row, position) pair fits in one int64 key.  No message comes close
+MAX_POSITIONS = 1 << 20
+
+###########################################################################
+
+def tokenize(text):
+	"""Lowercased runs of letters and digits"""
+	return TOKEN_PATTERN.findall(text.lower())
+
+class SearchIndex(object):
+	"""
+	`tokens` is the sorted vocabulary.  The postings of `tokens[i]` are `rows[offsets[i]:offsets[i + 1]]` and the same slice of `positions`
+	"""
+	def __init__(self, tokens, offsets, rows, positions):
+		self.tokens = tokens
+		self.offsets = offsets
+		self.rows = rows
+		self.positions = positions
+
+	def __len__(self):
+		"""The number of postings"""
+		return len(self.rows)
+
+	@classmethod
+	def build(cls, texts):
+		"""Indexes an iterable of texts, the row of each being its place in the iterable"""
+		token_ids = _TokenIds()
+		posting_tokens = array('I')
+		counts = array('I')
+		# Only the tokens are collected one at a time.  The rows and positions follow from the number of tokens in each row
+		for text in texts:
+			tokens = tokenize(text)[:MAX_POSITIONS]
+			posting_tokens.extend(map(token_ids.__getitem__, tokens))
+			counts.append(len(tokens))
+
+		counts = np.frombuffer(counts, dtype=np.uint32)
+		posting_rows = np.repeat(np.arange(len(counts), dtype=np.uint32), counts)
+		row_starts = np.cumsum(counts, dtype=np.int64) - counts
+		posting_positions = (np.arange(len(posting_rows), dtype=np.int64) - np.repeat(row_starts, counts)).astype(np.uint32)
+		vocabulary = np.array(list(token_ids), dtype=str)
+		return cls._from_postings(vocabulary, np.frombuffer(posting_tokens, dtype=np.uint32), posting_rows, posting_positions)
+
+	@classmethod
+	def merge(cls, indexes, row_offsets):
+		"""One index of several, with the rows of each moved up by its row offset.  The offsets have to go up, so the rows stay sorted"""
+		(vocabulary, token_ids) = np.unique(np.concatenate([np.empty(0, dtype=str)] + [index.tokens for index in indexes]), return_inverse=True)
+		(posting_tokens, posting_rows, posting_positions) = ([np.empty(0, dtype=np.intp)], [np.empty(0, dtype=np.uint32)], [np.empty(0, dtype=np.uint32)])
+		start = 0
+		for (index, row_offset) in zip(indexes, row_offsets):
+			index_token_ids = token_ids[start:start + len(index.tokens)]
+			start += len(index.tokens)
+			posting_tokens.append(np.repeat(index_token_ids, np.diff(index.offsets)))
+			posting_rows.append(index.rows + np.uint32(row_offset))
+			posting_positions.append(index.positions)
+		return cls._from_postings(vocabulary, np.concatenate(posting_tokens), np.concatenate(posting_rows), np.concatenate(posting_positions))
+
+	@classmethod
+	def _from_postings(cls, vocabulary, posting_tokens, posting_rows, posting_positions):
+		"""
+		Sorts the postings by token, with the tokens numbered in the order of `vocabulary`
+		The postings of each token have to be sorted by row and position already, which a stable sort keeps
+		"""
+		order = np.argsort(vocabulary, kind='stable')
+		ranks = np.empty(len(vocabulary), dtype=np.intp)
+		ranks[order] = np.arange(len(vocabulary))
+		posting_ranks = ranks[posting_tokens]
+
+		postings_order = np.argsort(posting_ranks, kind='stable')
+		offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+		np.cumsum(np.bincount(posting_ranks, minlength=len(vocabulary)), out=offsets[1:])
+		return cls(vocabulary[order], offsets, posting_rows[postings_order].astype(np.uint32), posting_positions[postings_order].astype(np.uint32))
+
+	def _postings(self, token):
+		idx = int(np.searchsorted(self.tokens, token))
+		if idx == len(self.tokens) or self.tokens[idx] != token:
+			return None
+		return slice(int(self.offsets[idx]), int(self.offsets[idx + 1]))
+
+	def find(self, query):
+		"""The sorted rows of the messages that have the tokens of the query one after another.  A query of one token is a plain term lookup"""
+		keys = None
+		for (place, token) in enumerate(tokenize(query)):
+			postings = self._postings(token)
+			if postings is None:
+				return np.empty(0, dtype=np.int64)
+			(rows, positions) = (self.rows[postings], self.positions[postings])
+			# Where the phrase would start, for every place the token is at
+			starts = positions >= place
+			token_keys = rows[starts].astype(np.int64) * MAX_POSITIONS + (positions[starts].astype(np.int64) - place)
+			keys = token_keys if keys is None else np.intersect1d(keys, token_keys, assume_unique=True)
+		if keys is None:
+			return np.empty(0, dtype=np.int64)
+		return np.unique(keys // MAX_POSITIONS)
+
+	def save(self, file_path, key):
+		# The rows of each token go up, so they are saved as the differences between them, which are small and compress well
+		row_deltas = np.diff(self.rows.astype(np.int64), prepend=0)
+		starts = self.offsets[:-1][np.diff(self.offsets) > 0]
+		row_deltas[starts] = self.rows[starts]
+		with atomic_path(file_path) as tmp_path, open(tmp_path, 'wb') as f:
+			np.savez_compressed(f, key=np.array(key), tokens=self.tokens, offsets=self.offsets,
+				row_deltas=_narrowed(row_deltas), positions=_narrowed(self.positions))
+
+	@classmethod
+	def load(cls, file_path, key):
+		"""Returns the saved index, or None if there is none or it was built with another key"""
+		try:
+			with np.load(file_path) as data:
+				if str(data['key']) != key:
+					return None
+				offsets = data['offsets']
+				sums = np.cumsum(data['row_deltas'], dtype=np.int64)
+				# Every token starts over from its first row
+				lengths = np.diff(offsets)
+				before = np.concatenate([[0], sums])[offsets[:-1]]
+				rows = (sums - np.repeat(before, lengths)).astype(np.uint32)
+				return cls(data['tokens'], offsets, rows, data['positions'].astype(np.uint32))
+		except (OSError, ValueError, KeyError):
+			return None
+
+class _TokenIds(dict):
+	"""Numbers the tokens in the order they are first looked up"""
+	def __missing__(self, token):
+		token_id = self[token] = len(self)
+		return token_id
+
+def _narrowed(values):
+	"""The values in the smallest unsigned type that holds them all"""
+	return values.astype(np.min_scalar_type(int(values.max()) if len(values) else 0))
@@ -0,0 +1,195 @@
+"""
+A small asyncio HTTP/JSON server for the `--serve` mode of analyze-messages.py
+
+Every query is a GET of a route with its parameters in the query string, and is answered with a json body.  The conversations don't
+change while the server runs, so the answers are cached by route and parameters, and a repeated query is only a dict lookup.
+The routes run one at a time on the event loop.  They are quick numpy work on data that is already in memory, and the conversations
+build their histories and indexes lazily, which is not safe to do from several threads at once
+"""
+
+import asyncio
+from collections import OrderedDict
+from http import HTTPStatus
+import json
+import signal
+import sys
+import traceback
+from urllib.parse import parse_qsl, urlsplit
+
+###########################################################################
+# Constants
+
+# How many answers the response cache keeps, the least recently used are dropped first
+RESPONSE_CACHE_SIZE = 1024
+
+# Requests with a longer line or more header lines than this are refused
+MAX_LINE_BYTES = 1 << 16
+MAX_HEADERS = 100
+
+###########################################################################
+
+class QueryError(ValueError):
+	"""Raised by a route for a query it can't answer.  The client gets a 400 with the message"""
+
+class ResponseCache(object):
+	"""The encoded answers by (path, sorted parameters), least recently used first"""
+	def __init__(self, max_entries=RESPONSE_CACHE_SIZE):
+		self.max_entries = max_entries
+		self.hits = 0
+		self.misses = 0
+		self._entries = OrderedDict()
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key):
+		body = self._entries.get(key)
+		if body is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self._entries.move_to_end(key)
+		return body
+
+	def put(self, key, body):
+		self._entries[key] = body
+		self._entries.move_to_end(key)
+		while len(self._entries) > self.max_entries:
+			self._entries.popitem(last=False)
+
+class QueryServer(object):
+	"""
+	Answers GET requests with the json of `routes[path](params)`, where `params` is a dict of the query string
+	`/` lists the routes with the first line of their docstrings
+	"""
+	def __init__(self, routes, cache_size=RESPONSE_CACHE_SIZE):
+		self.routes = dict(routes)
+		self.routes.setdefault('/', self._list_routes)
+		self.cache = ResponseCache(cache_size)
+		self.num_requests = 0
+
+	def _list_routes(self, params):
+		return {path: (route.__doc__ or '').strip().split('\n')[0] for (path, route) in sorted(self.routes.items()) if path != '/'}
+
+	def respond(self, target):
+		"""
+		Returns the (status, json body, whether it came from the cache) of a request target like '/summaries?top=5'
+		Only successful answers are cached
+		"""
+		url = urlsplit(target)
+		route = self.routes.get(url.path)
+		if route is None:
+			return (HTTPStatus.NOT_FOUND, _error_body('No route {}'.format(url.path)), False)
+
+		params = parse_qsl(url.query, keep_blank_values=True)
+		key = (url.path, tuple(sorted(params)))
+		body = self.cache.get(key)
+		if body is not None:
+			return (HTTPStatus.OK, body, True)
+
+		try:
+			body = json.dumps(route(dict(params)), separators=(',', ':')).encode('utf-8')
+		except QueryError as e:
+			return (HTTPStatus.BAD_REQUEST, _error_body(str(e)), False)
+		except Exception:
+			# Any other error is a bug in the route.  It is logged and answered, so the server and the connection keep going
+			print('Error answering {}'.format(target), file=sys.stderr)
+			traceback.print_exc()
+			return (HTTPStatus.INTERNAL_SERVER_ERROR, _error_body('Internal error answering {}'.format(url.path)), False)
+		self.cache.put(key, body)
+		return (HTTPStatus.OK, body, False)
+
+	async def handle_connection(self, reader, writer):
+		"""Answers the requests of one connection, which is kept open between them unless the client asks otherwise"""
+		try:
+			while True:
+				request = await _read_request(reader)
+				if request is None:
+					break
+				(method, target, keep_alive) = request
+				self.num_requests += 1
+
+				if method not in ('GET', 'HEAD'):
+					(status, body, cached) = (HTTPStatus.METHOD_NOT_ALLOWED, _error_body('Only GET is supported'), False)
+				else:
+					(status, body, cached) = self.respond(target)
+
+				writer.write(_response_head(status, len(body), cached, keep_alive))
+				if method != 'HEAD':
+					writer.write(body)
+				await writer.drain()
+				if not keep_alive:
+					break
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		except ValueError:
+			writer.write(_response_head(HTTPStatus.BAD_REQUEST, 0, False, False))
+		finally:
+			writer.close()
+
+	async def serve_forever(self, host, port):
+		"""Serves until SIGINT or SIGTERM"""
+		server = await asyncio.start_server(self.handle_connection, host, port)
+		stopped = asyncio.Event()
+		loop = asyncio.get_running_loop()
+		for signum in (signal.SIGINT, signal.SIGTERM):
+			try:
+				loop.add_signal_handler(signum, stopped.set)
+			except NotImplementedError:
+				# Windows, where ctrl-c still raises KeyboardInterrupt
+				pass
+		async with server:
+			await stopped.wait()
+
+def serve(routes, host, port, cache_size=RESPONSE_CACHE_SIZE):
+	"""Serves the routes until interrupted.  Returns the QueryServer, for its request and cache counts"""
+	query_server = QueryServer(routes, cache_size=cache_size)
+	try:
+		asyncio.run(query_server.serve_forever(host, port))
+	except KeyboardInterrupt:
+		pass
+	return query_server
+
+async def _read_request(reader):
+	"""Returns the (method, target, keep_alive) of the next request, or None once the client closed the connection"""
+	line = await reader.readline()
+	if not line:
+		return None
+	if len(line) > MAX_LINE_BYTES:
+		raise ValueError('Request line too long')
+	parts = line.decode('latin-1').split()
+	if len(parts) != 3:
+		raise ValueError('Bad request line')
+	(method, target, version) = parts
+
+	headers = {}
+	while True:
+		line = await reader.readline()
+		if line in (b'\r\n', b'\n', b''):
+			break
+		if len(line) > MAX_LINE_BYTES or len(headers) >= MAX_HEADERS:
+			raise ValueError('Headers too long')
+		(name, _, value) = line.decode('latin-1').partition(':')
+		headers[name.strip().lower()] = value.strip().lower()
+
+	# The queries have no body, but one that was sent anyway has to be read past to get to the next request
+	content_length = int(headers.get('content-length', 0))
+	if content_length:
+		await reader.readexactly(content_length)
+
+	connection = headers.get('connection', '')
+	keep_alive = connection == 'keep-alive' if version == 'HTTP/1.0' else connection != 'close'
+	return (method, target, keep_alive)
+
+def _response_head(status, content_length, cached, keep_alive):
+	return ('HTTP/1.1 {} {}\r\n'
+		'Content-Type: application/json\r\n'
+		'Content-Length: {}\r\n'
+		# So a dashboard on another origin can query it
+		'Access-Control-Allow-Origin: *\r\n'
+		'X-Cache: {}\r\n'
+		'Connection: {}\r\n'
+		'\r\n').format(status.value, status.phrase, content_length, 'hit' if cached else 'miss', 'keep-alive' if keep_alive else 'close').encode('latin-1')
+
+def _error_body(message):
+	return json.dumps({'error': message}).encode('utf-8')
@@ -0,0 +1,189 @@
+"""
+Bounded-memory sketches of the words written in a conversation, for `--vocabulary` in analyze-messages.py
+
+A WordSketch holds three sketches, and each of them can be merged with another of the same size:
+- HyperLogLog for the number of distinct words
+- Space-Saving for the most used words
+- Count-Min for the count of any word, which also narrows the Space-Saving counts down
+They are fed the exact word counts of one json file at a time, so only one file's words are ever counted exactly.
+Their size doesn't depend on the number of messages, and every number they give comes with a bound on its error
+"""
+
+import base64
+import hashlib
+import heapq
+import math
+
+import numpy as np
+
+###########################################################################
+# Constants
+
+# 2**11 one-byte registers, for a standard error of 1.04 / sqrt(2**11), about 2.3%
+HLL_PRECISION = 11
+
+# Counts are over by at most e / CMS_WIDTH of all the words, with a probability of 1 - e**-CMS_DEPTH, about 98%
+CMS_WIDTH = 512
+CMS_DEPTH = 4
+
+# Words the Space-Saving summary keeps.  More than are ever shown, so the shown ones are counted closely
+TOP_WORDS_CAPACITY = 100
+
+###########################################################################
+
+def hash_words(words):
+	"""A 64 bit hash of each word, the same in every process, unlike `hash`"""
+	return np.frombuffer(b''.join(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest() for word in words), dtype='<u8').astype(np.uint64)
+
+class HyperLogLog(object):
+	def __init__(self, precision=HLL_PRECISION, registers=None):
+		self.precision = precision
+		self.registers = registers if registers is not None else np.zeros(1 << precision, dtype=np.uint8)
+
+	def add_hashes(self, hashes):
+		# The first bits pick the register, which keeps the most leading zeros seen in the rest, plus one.  Only 52 bits of the rest are
+		# looked at, which float64 holds exactly for frexp
+		idxs = (hashes >> np.uint64(64 - self.precision)).astype(np.intp)
+		rest = (hashes & np.uint64((1 << 52) - 1)).astype(np.float64)
+		ranks = (53 - np.frexp(rest)[1]).astype(np.uint8)
+		np.maximum.at(self.registers, idxs, ranks)
+
+	def merge(self, other):
+		np.maximum(self.registers, other.registers, out=self.registers)
+
+	def estimate(self):
+		num_registers = len(self.registers)
+		alpha = 0.7213 / (1 + 1.079 / num_registers)
+		estimate = alpha * num_registers ** 2 / np.sum(np.ldexp(1.0, -self.registers.astype(np.int64)))
+		zeros = int(np.count_nonzero(self.registers == 0))
+		# Small counts are estimated from the empty registers instead
+		if estimate <= 2.5 * num_registers and zeros:
+			estimate = num_registers * math.log(num_registers / zeros)
+		return int(round(estimate))
+
+	def relative_error(self):
+		"""The standard error of the estimate, relative to the count"""
+		return 1.04 / math.sqrt(len(self.registers))
+
+class CountMinSketch(object):
+	def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH, table=None, total=0):
+		self.width = width
+		self.depth = depth
+		self.table = table if table is not None else np.zeros((depth, width), dtype=np.uint32)
+		self.total = total
+
+	def _columns(self, hashes):
+		# One column per row from two halves of the hash
+		(low, high) = (hashes & np.uint64(0xffffffff), (hashes >> np.uint64(32)) | np.uint64(1))
+		return [((low + np.uint64(row) * high) % np.uint64(self.width)).astype(np.intp) for row in range(self.depth)]
+
+	def add_hashes(self, hashes, counts):
+		for (row, columns) in enumerate(self._columns(hashes)):
+			self.table[row] += np.bincount(columns, weights=counts, minlength=self.width).astype(np.uint32)
+		self.total += int(counts.sum())
+
+	def estimate_hashes(self, hashes):
+		"""Counts that are never under, and over by at most `error()` with probability `confidence()`"""
+		return np.min([self.table[row][columns] for (row, columns) in enumerate(self._columns(hashes))], axis=0)
+
+	def merge(self, other):
+		self.table += other.table
+		self.total += other.total
+
+	def error(self):
+		return math.e / self.width * self.total
+
+	def confidence(self):
+		return 1 - math.exp(-self.depth)
+
+class SpaceSaving(object):
+	"""
+	The most used words, with counts that are never under and over by at most their error
+	`floor` is the most a word that is not kept can have been used
+	"""
+	def __init__(self, capacity=TOP_WORDS_CAPACITY, counts=None, errors=None, floor=0):
+		self.capacity = capacity
+		self.counts = counts if counts is not None else {}
+		self.errors = errors if errors is not None else {}
+		self.floor = floor
+
+	def merge_counts(self, counts, errors=None, floor=0):
+		"""Merges in another summary, or exact counts if it has no errors and floor"""
+		errors = errors or {}
+		# Of the words that are only in `counts`, no more than its `capacity` most used can be kept.  The others only raise the floor
+		candidates = heapq.nsmallest(self.capacity + 1, counts, key=lambda word: (-counts[word], word))
+		rest = self.floor + counts[candidates.pop()] if len(candidates) > self.capacity else 0
+		merged = {}
+		merged_errors = {}
+		for word in set(self.counts).union(candidates):
+			merged[word] = self.counts.get(word, self.floor) + counts.get(word, floor)
+			merged_errors[word] = self.errors.get(word, self.floor) + errors.get(word, floor)
+		kept = heapq.nsmallest(self.capacity, merged, key=lambda word: (-merged[word], word))
+		dropped = max((merged[word] for word in set(merged).difference(kept)), default=0)
+		self.floor = max(self.floor + floor, dropped, rest)
+		self.counts = {word: merged[word] for word in kept}
+		self.errors = {word: merged_errors[word] for word in kept}
+
+	def merge(self, other):
+		self.merge_counts(other.counts, other.errors, other.floor)
+
+	def top(self, num):
+		"""The (word, count, error) of the `num` most used words"""
+		return [(word, self.counts[word], self.errors[word]) for word in heapq.nsmallest(num, self.counts, key=lambda word: (-self.counts[word], word))]
+
+class WordSketch(object):
+	"""The words one side of a conversation wrote"""
+	def __init__(self, distinct=None, counts=None, top_words=None):
+		self.distinct = distinct if distinct is not None else HyperLogLog()
+		self.counts = counts if counts is not None else CountMinSketch()
+		self.top_words = top_words if top_words is not None else SpaceSaving()
+
+	def add_counts(self, word_counts):
+		"""Adds exact counts, like a Counter of the words of one file"""
+		if not word_counts:
+			return
+		words = list(word_counts)
+		hashes = hash_words(words)
+		self.distinct.add_hashes(hashes)
+		self.counts.add_hashes(hashes, np.array([word_counts[word] for word in words], dtype=np.int64))
+		self.top_words.merge_counts(word_counts)
+
+	def merge(self, other):
+		self.distinct.merge(other.distinct)
+		self.counts.merge(other.counts)
+		self.top_words.merge(other.top_words)
+
+	def num_words(self):
+		return self.counts.total
+
+	def top(self, num):
+		"""
+		The (word, low, high) of the `num` most used words, where the word was used from `low` to `high` times
+		Both sketches only ever count over, so the lower of their counts is the upper bound
+		"""
+		top = self.top_words.top(num)
+		estimates = self.counts.estimate_hashes(hash_words([word for (word, _, _) in top])).tolist() if top else []
+		return [(word, count - error, min(count, estimate)) for ((word, count, error), estimate) in zip(top, estimates)]
+
+	def to_cache_dict(self):
+		return {
+			'registers': _encode_array(self.distinct.registers),
+			'table': _encode_array(self.counts.table),
+			'total': self.counts.total,
+			'top_counts': self.top_words.counts,
+			'top_errors': self.top_words.errors,
+			'floor': self.top_words.floor,
+		}
+
+	@classmethod
+	def from_cache_dict(cls, data):
+		return cls(distinct=HyperLogLog(registers=_decode_array(data['registers'], np.uint8, (1 << HLL_PRECISION,))),
+			counts=CountMinSketch(table=_decode_array(data['table'], np.uint32, (CMS_DEPTH, CMS_WIDTH)), total=data['total']),
+			top_words=SpaceSaving(counts=data['top_counts'], errors=data['top_errors'], floor=data['floor']))
+
+def _encode_array(values):
+	return base64.b64encode(values.tobytes()).decode('ascii')
+
+def _decode_array(encoded, dtype, shape):
+	# Copied, as arrays on top of bytes are read-only and the sketches get merged into
+	return np.frombuffer(base64.b64decode(encoded), dtype=dtype).reshape(shape).copy()